@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+# Offline load test: runs main.py (MODE=webhook) against local stand-ins for
+# the Telegram Bot API and Crypto Pay, replays a synthetic update stream and
+# reports updates/s and p50/p99 latency per update kind and database size.
+#
+#   python bench.py                                # 10k, 100k, 1M records, json
+#   python bench.py --sizes 10000 --storage sqlite --updates 5000
+#   python bench.py --memory --sizes 1000000       # RSS: plain dicts vs COMPACT_RECORDS
+#   python bench.py --sizes 10000 --storage sqlite --procs 1,2,4   # WORKERS=1, 2, 4
+#
+# Latency of one update = time from POSTing it to the webhook until the fake
+# Telegram server receives the call that finishes it (sendDocument for a
+# download, answerCallbackQuery for chk:, ...).
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+MAIN_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+ADMIN_ID = 1
+BOT_TOKEN = "123456:bench"
+CRYPTO_TOKEN = "bench-crypto"
+WEBHOOK_SECRET = "bench-webhook-secret"
+
+# update kind -> (Telegram method that completes it, share of the stream)
+KINDS = {
+    "download": ("sendDocument", 0.55),
+    "upload": ("sendMessage", 0.15),
+    "pay": ("sendMessage", 0.1),
+    "chk": ("answerCallbackQuery", 0.15),
+    "stats": ("sendMessage", 0.05),
+}
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def serve(handler_cls) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), handler_cls)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# =======================
+# FAKE TELEGRAM
+# =======================
+class Tracker:
+    # matches outgoing bot calls to the synthetic updates waiting for them
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = defaultdict(deque)  # (method, key) -> deque[(kind, sent_at)]
+        self.done = []                     # (kind, latency_s, finished_at)
+        self.calls = defaultdict(int)
+
+    def expect(self, method: str, key, kind: str, sent_at: float):
+        with self.lock:
+            self.waiting[(method, str(key))].append((kind, sent_at))
+
+    def hit(self, method: str, key):
+        now = time.perf_counter()
+        with self.lock:
+            self.calls[method] += 1
+            q = self.waiting.get((method, str(key)))
+            if q:
+                kind, sent_at = q.popleft()
+                self.done.append((kind, now - sent_at, now))
+
+    def reset(self):
+        with self.lock:
+            self.waiting.clear()
+            self.done.clear()
+            self.calls.clear()
+
+tracker = Tracker()
+_msg_ids = iter(range(10_000_000, 1 << 62))
+
+def tg_message(chat_id, **extra) -> dict:
+    return {"message_id": next(_msg_ids), "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private" if int(chat_id) > 0 else "channel"}, **extra}
+
+class FakeTelegram(BaseHTTPRequestHandler):
+    def do_POST(self):
+        url = urlparse(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+
+        chat_id = params.get("chat_id", 0)
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = tg_message(chat_id, text=params.get("text", ""))
+        elif method in ("sendDocument", "forwardMessage"):
+            n = next(_msg_ids)
+            result = tg_message(chat_id, document={"file_id": f"BK{n}", "file_unique_id": f"BU{n}"})
+        elif method == "forwardMessages":
+            result = [{"message_id": next(_msg_ids)} for _ in json.loads(params.get("message_ids", "[]"))]
+        elif method == "getFile":
+            result = {"file_id": params.get("file_id"), "file_unique_id": "U" + params.get("file_id", "")}
+        else:
+            result = True
+
+        key = params.get("callback_query_id") if method == "answerCallbackQuery" else chat_id
+        tracker.hit(method, key)
+        out = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    do_GET = do_POST
+
+    def log_message(self, fmt, *args):
+        pass
+
+# =======================
+# FAKE CRYPTO PAY
+# =======================
+class FakeCryptoPay(BaseHTTPRequestHandler):
+    invoice_ids = iter(range(5_000_000, 1 << 62))
+
+    def do_POST(self):
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self.headers.get("Crypto-Pay-API-Token") != CRYPTO_TOKEN:
+            out = {"ok": False, "error": {"code": 401, "name": "UNAUTHORIZED"}}
+        elif method == "createInvoice":
+            n = next(self.invoice_ids)
+            out = {"ok": True, "result": {"invoice_id": n, "status": "active", "pay_url": f"https://t.me/CryptoBot?start=IV{n}"}}
+        elif method == "getInvoices":
+            ids = [i for i in str(payload.get("invoice_ids", "")).split(",") if i]
+            out = {"ok": True, "result": {"items": [
+                {"invoice_id": int(i), "status": random.choice(("active", "active", "paid", "expired"))} for i in ids
+            ]}}
+        else:
+            out = {"ok": True, "result": {}}
+        body = json.dumps(out).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+# =======================
+# DATASET
+# =======================
+def write_database(path: str, size: int):
+    # streamed so 1M records don't need to exist in memory at once
+    now = time.time()
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"files":{')
+        for i in range(size):
+            rec = {"file_id": f"F{i}", "file_unique_id": f"FU{i}", "file_name": f"file{i}.bin",
+                   "mime_type": "application/octet-stream", "u_id": 2 + i, "u_tag": f"@user{2 + i}",
+                   "created_at": "2025-01-01 00:00 UTC", "backup_chat": "-100", "backup_msg_id": i}
+            f.write(("," if i else "") + json.dumps(f"c{i}") + ":" + json.dumps(rec, separators=(",", ":")))
+        f.write('},"users":{')
+        for i in range(size):
+            uid = 2 + i
+            until = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(now + (86400 * 30 if uid % 2 == 0 else -86400)))
+            rec = {"id": uid, "username": f"user{uid}", "tag": f"@user{uid}", "first_name": "U", "last_name": "",
+                   "last_seen": None, "sub_until": until, "last_invoice": None}
+            f.write(("," if i else "") + f'"{uid}":' + json.dumps(rec, separators=(",", ":")))
+        f.write('},"invoices":{')
+        for i in range(max(1, size // 10)):
+            rec = {"invoice_id": str(i), "user_id": 2 + i, "created_at": None,
+                   "status": "paid" if i % 3 == 0 else "expired", "amount_usd": 0.5, "pay_url": ""}
+            f.write(("," if i else "") + f'"{i}":' + json.dumps(rec, separators=(",", ":")))
+        f.write('},"settings":{"monthly_price_usd":0.5}}')
+
+def pick_user(kind: str, size: int, rnd: random.Random, used: set) -> int:
+    # a fresh chat per update where possible, so replies can't be mismatched
+    for _ in range(100):
+        if kind == "upload":
+            uid = 2 + 2 * rnd.randrange(max(1, size // 2))  # even ids have an active subscription
+        else:
+            uid = 2 + rnd.randrange(size)
+        if uid not in used:
+            break
+    used.add(uid)
+    return uid
+
+def make_update(update_id: int, kind: str, size: int, rnd: random.Random, used: set) -> tuple[dict, str, object]:
+    # returns (update, completing method, tracker key)
+    uid = ADMIN_ID if kind == "stats" else pick_user(kind, size, rnd, used)
+    user = {"id": uid, "is_bot": False, "first_name": "U", "username": f"user{uid}"}
+    msg = {"message_id": update_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": user}
+    method = KINDS[kind][0]
+
+    if kind == "download":
+        msg["text"] = f"/start c{rnd.randrange(size)}"
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": 6}]
+    elif kind == "pay":
+        msg["text"] = "/pay"
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": 4}]
+    elif kind == "upload":
+        msg["document"] = {"file_id": f"N{update_id}", "file_unique_id": f"NU{update_id}",
+                           "file_name": f"new{update_id}.bin", "mime_type": "application/octet-stream"}
+    else:
+        data = "adm:stats" if kind == "stats" else f"chk:{rnd.randrange(max(1, size // 10))}"
+        cq_id = f"cq{update_id}"
+        return {"update_id": update_id, "callback_query": {
+            "id": cq_id, "from": user, "chat_instance": "bench", "data": data, "message": msg,
+        }}, method, (cq_id if kind == "chk" else uid)
+    return {"update_id": update_id, "message": msg}, method, uid
+
+# =======================
+# RUN
+# =======================
+def wait_port(port: int, proc: subprocess.Popen, timeout: float) -> float:
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < timeout:
+        if proc.poll() is not None:
+            raise SystemExit(f"main.py exited with {proc.returncode}")
+        with socket.socket() as s:
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                return time.perf_counter() - t0
+        time.sleep(0.05)
+    raise SystemExit("main.py did not start in time")
+
+def rss_mb(pid: int, field: str = "VmRSS") -> float:
+    # VmRSS: now, VmHWM: peak
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+def cpu_s(pid: int) -> tuple[float, float]:
+    # CPU seconds (user + system) of pid and of all its descendants (WORKERS processes)
+    def own(p):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except OSError:
+            return 0.0
+
+    def children(p):
+        kids = []
+        try:
+            for task in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{task}/children") as f:
+                    kids += [int(k) for k in f.read().split()]
+        except OSError:
+            pass
+        return kids + [g for k in kids for g in children(k)]
+
+    return own(pid), sum(own(k) for k in children(pid))
+
+def pct(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def start_bot(workdir: str, port: int, args, tg_url: str, cp_url: str, **extra) -> subprocess.Popen:
+    cfg = {
+        "TOKEN": BOT_TOKEN, "ADMIN_ID": ADMIN_ID, "CRYPTOPAY_TOKEN": CRYPTO_TOKEN, "CHANNEL_ID": "-100",
+        "TELEGRAM_API_URL": tg_url, "CRYPTOPAY_BASE": cp_url, "STORAGE": args.storage,
+        "MODE": "webhook", "WEBHOOK_LISTEN": "127.0.0.1", "WEBHOOK_PORT": port, "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "WEBHOOK_WORKERS": args.workers, "WEBHOOK_QUEUE": 100000, "RECONCILE_INTERVAL": 3600,
+        # measure the bot, not Telegram's flood limits
+        "SEND_GLOBAL_RATE": 1e6, "SEND_CHAT_RATE": 1e6, "SEND_CHAT_BURST": 1000,
+        **json.loads(args.config),
+        **extra,
+    }
+    with open(os.path.join(workdir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(cfg, f)
+    return subprocess.Popen([sys.executable, MAIN_PY], cwd=workdir,
+                            stdout=subprocess.DEVNULL if not args.verbose else None)
+
+def stop_bot(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+def run_size(size: int, args, tg_url: str, cp_url: str, procs: int = 1) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"bench-{size}-")
+    port = free_port()
+    try:
+        write_database(os.path.join(workdir, "database.json"), size)
+        extra = {"WORKERS": procs, "STORAGE": "sqlite"} if procs > 1 else {}
+        proc = start_bot(workdir, port, args, tg_url, cp_url, **extra)
+        try:
+            startup = wait_port(port, proc, args.startup_timeout)
+            tracker.reset()
+            rnd = random.Random(size)
+            kinds = list(KINDS)
+            weights = [KINDS[k][1] for k in kinds]
+            used = set()
+            stream = []
+            for i in range(1, args.updates + 1):
+                kind = rnd.choices(kinds, weights)[0]
+                update, method, key = make_update(i, kind, size, rnd, used)
+                stream.append((kind, json.dumps(update).encode(), method, key))
+            url = f"http://127.0.0.1:{port}/telegram"
+
+            def post(item):
+                kind, data, method, key = item
+                tracker.expect(method, key, kind, time.perf_counter())
+                req = urllib.request.Request(url, data=data, headers={
+                    "Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET,
+                })
+                try:
+                    urllib.request.urlopen(req, timeout=30).read()
+                except urllib.error.URLError as e:
+                    print(f"POST failed: {e}")
+
+            cpu0 = cpu_s(proc.pid)
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                list(pool.map(post, stream))
+            deadline = time.perf_counter() + args.drain_timeout
+            while len(tracker.done) < args.updates and time.perf_counter() < deadline:
+                time.sleep(0.05)
+            elapsed = (max(t for *_, t in tracker.done) - t0) if tracker.done else 0.0
+            rss = rss_mb(proc.pid)
+            cpu = [b - a for a, b in zip(cpu0, cpu_s(proc.pid))]
+        finally:
+            stop_bot(proc)
+
+        by_kind = defaultdict(list)
+        for kind, latency, _ in tracker.done:
+            by_kind[kind].append(latency)
+        all_lat = [latency for _, latency, _ in tracker.done]
+        return {
+            "size": size, "procs": procs, "startup_s": startup, "completed": len(all_lat), "sent": args.updates,
+            "updates_per_s": len(all_lat) / elapsed if elapsed else 0.0, "rss_mb": rss,
+            "p50_ms": pct(all_lat, 0.5) * 1000, "p99_ms": pct(all_lat, 0.99) * 1000,
+            # CPU per update: the main process (the supervisor with WORKERS > 1) and the workers
+            "cpu_ms_main": cpu[0] * 1000 / max(1, len(all_lat)), "cpu_ms_workers": cpu[1] * 1000 / max(1, len(all_lat)),
+            "kinds": {k: {"n": len(v), "p50_ms": pct(v, 0.5) * 1000, "p99_ms": pct(v, 0.99) * 1000,
+                          "mean_ms": statistics.fmean(v) * 1000} for k, v in sorted(by_kind.items())},
+            "api_calls": dict(tracker.calls),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_memory(size: int, args, tg_url: str, cp_url: str) -> dict:
+    # the same database.json loaded as plain dicts and as compact records
+    workdir = tempfile.mkdtemp(prefix=f"bench-mem-{size}-")
+    try:
+        write_database(os.path.join(workdir, "database.json"), size)
+        out = {"size": size}
+        for name, compact in (("dicts", False), ("compact", True)):
+            port = free_port()
+            proc = start_bot(workdir, port, args, tg_url, cp_url, STORAGE="json", COMPACT_RECORDS=compact)
+            try:
+                startup = wait_port(port, proc, args.startup_timeout)
+                out[name] = {"startup_s": startup, "rss_mb": rss_mb(proc.pid), "peak_mb": rss_mb(proc.pid, "VmHWM")}
+            finally:
+                stop_bot(proc)
+        return out
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_memory_report(r: dict):
+    d, c = r["dicts"], r["compact"]
+    saved = (1 - c["rss_mb"] / d["rss_mb"]) * 100 if d["rss_mb"] else 0.0
+    print(f"\n== {r['size']:,} files/users, STORAGE=json ==")
+    for name, m in (("dicts", d), ("compact", c)):
+        print(f"  {name:<8} RSS {m['rss_mb']:7.0f} MB  peak {m['peak_mb']:7.0f} MB  startup {m['startup_s']:6.2f} s")
+    print(f"  compact records: {saved:.0f}% less RSS")
+
+def print_report(r: dict):
+    print(f"\n== {r['size']:,} files/users" + (f", WORKERS={r['procs']}" if r["procs"] > 1 else "") + " ==")
+    print(f"startup {r['startup_s']:.2f} s, RSS {r['rss_mb']:.0f} MB, "
+          f"{r['completed']}/{r['sent']} done, {r['updates_per_s']:.0f} updates/s, "
+          f"p50 {r['p50_ms']:.1f} ms, p99 {r['p99_ms']:.1f} ms")
+    print(f"CPU per update: main {r['cpu_ms_main']:.2f} ms"
+          + (f", workers {r['cpu_ms_workers']:.2f} ms" if r["procs"] > 1 else ""))
+    for kind, k in r["kinds"].items():
+        print(f"  {kind:<9} n={k['n']:<6} p50 {k['p50_ms']:7.1f} ms  p99 {k['p99_ms']:7.1f} ms  mean {k['mean_ms']:7.1f} ms")
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline throughput/latency benchmark for main.py")
+    ap.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated DB sizes (files and users)")
+    ap.add_argument("--updates", type=int, default=2000, help="updates per size")
+    ap.add_argument("--concurrency", type=int, default=32, help="parallel webhook POSTs")
+    ap.add_argument("--workers", type=int, default=8, help="WEBHOOK_WORKERS of the bot")
+    ap.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    ap.add_argument("--config", default="{}", help="extra config.json keys as JSON")
+    ap.add_argument("--startup-timeout", type=float, default=600)
+    ap.add_argument("--drain-timeout", type=float, default=60)
+    ap.add_argument("--json", dest="json_out", help="also write results to this file")
+    ap.add_argument("--verbose", action="store_true", help="show main.py output")
+    ap.add_argument("--procs", default="1",
+                    help="comma-separated WORKERS values to run every size with (above 1: STORAGE=sqlite)")
+    ap.add_argument("--memory", action="store_true",
+                    help="compare RSS after startup with COMPACT_RECORDS off and on instead of replaying updates")
+    args = ap.parse_args()
+
+    tg = serve(FakeTelegram)
+    cp = serve(FakeCryptoPay)
+    tg_url = f"http://127.0.0.1:{tg.server_address[1]}"
+    cp_url = f"http://127.0.0.1:{cp.server_address[1]}/api/"
+
+    results = []
+    for size in (int(x) for x in args.sizes.split(",") if x.strip()):
+        if args.memory:
+            r = run_memory(size, args, tg_url, cp_url)
+            print_memory_report(r)
+            results.append(r)
+            continue
+        for procs in (int(x) for x in args.procs.split(",") if x.strip()):
+            r = run_size(size, args, tg_url, cp_url, procs)
+            print_report(r)
+            results.append(r)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,48 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import atexit
+import bisect
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
+import html
+import io
 import json
+import multiprocessing
+import operator
 import os
+import queue
 import random
+import re
+import signal
+import sqlite3
 import string
+import sys
+import threading
 import time
+from array import array
+from collections import Counter, OrderedDict, deque
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import requests
 import telebot
-from telebot import types
+from requests.adapters import HTTPAdapter
+from telebot import apihelper, types
+
+try:
+    import aiohttp  # only for ENGINE=async
+except ImportError:
+    aiohttp = None
 
 CONFIG_PATH = "config.json"
 DB_PATH = "database.json"
+SNAPSHOT_STATE_PATH = "snapshot.json"
 
 # =======================
 # CONFIG
@@ -35,13 +66,101 @@ def load_config():
     if not crypto_token:
         raise SystemExit("❌ В config.json не задан CRYPTOPAY_TOKEN (Crypto Pay API)")
 
-    channel_id = str(cfg.get("CHANNEL_ID", "")).strip()
-    if not channel_id:
+    channels = cfg.get("CHANNEL_ID", "")
+    if not isinstance(channels, list):
+        channels = [channels]
+    channels = [str(c).strip() for c in channels if str(c).strip()]
+    if not channels:
         raise SystemExit("❌ В config.json не задан CHANNEL_ID (группа/канал для бэкапа файлов).")
 
-    cfg["CHANNEL_ID"] = channel_id
+    cfg["CHANNEL_ID"] = channels                  # один id или список: первый — основной (снапшоты БД)
+    cfg.setdefault("BACKUP_QUORUM", 1)            # копий в CHANNEL_ID, после которых задача бэкапа выполнена
+    cfg.setdefault("BACKUP_WORKERS", 8)           # потоков пересылки в бэкап-каналы
+    cfg.setdefault("BACKUP_RETRY_BASE", 5)        # сек до повтора неудачного бэкапа, дальше x2
+    cfg.setdefault("BACKUP_RETRY_MAX", 3600)      # потолок паузы между повторами (сек)
+    cfg.setdefault("BACKUP_MAX_ATTEMPTS", 20)     # попыток бэкапа файла, после которых задача уходит в неудачные
+    cfg.setdefault("BACKUP_LEASE", 300)           # сек, после которых взятая задача бэкапа считается потерянной
+    cfg.setdefault("BACKUP_POLL", 5)              # сек между проверками очереди бэкапа
     cfg.setdefault("CRYPTOPAY_BASE", "https://pay.crypt.bot/api/")
+    cfg.setdefault("TELEGRAM_API_URL", "")        # свой Bot API сервер (или заглушка bench.py)
     cfg.setdefault("DEFAULT_PRICE_USD", 0.5)
+    cfg.setdefault("DB_FLUSH_INTERVAL", 2.0)      # сек между сбросами database.json на диск
+    cfg.setdefault("DB_FLUSH_MAX_PENDING", 500)   # сбросить раньше, если накопилось столько изменений
+    cfg.setdefault("STORAGE", "json")             # json | sqlite
+    cfg.setdefault("SQLITE_PATH", "database.sqlite3")
+    cfg.setdefault("COMPACT_RECORDS", False)      # STORAGE=json: файлы и пользователи компактно в памяти (меньше RAM, больше CPU)
+    cfg.setdefault("RECONCILE_INTERVAL", 20)      # сек между проверками открытых счетов
+    cfg.setdefault("RECONCILE_BATCH", 100)        # счетов в одном getInvoices (макс. 1000)
+    cfg.setdefault("CRYPTOPAY_TIMEOUT", [3.05, 10])  # connect, read (сек)
+    cfg.setdefault("CRYPTOPAY_RETRIES", 2)
+    cfg.setdefault("CRYPTOPAY_POOL_SIZE", 16)
+    cfg.setdefault("CRYPTOPAY_BREAKER_THRESHOLD", 5)  # подряд неудачных вызовов до размыкания
+    cfg.setdefault("CRYPTOPAY_BREAKER_COOLDOWN", 30)  # сек без запросов к Crypto Pay после размыкания
+    cfg.setdefault("DEDUP_POLICY", "alias")       # повторная загрузка того же файла: alias | link | off
+    cfg.setdefault("ALBUM_WINDOW", 1.0)           # сек ожидания остальных файлов альбома
+    cfg.setdefault("SEND_GLOBAL_RATE", 30)        # сообщений/сек на весь бот
+    cfg.setdefault("SEND_CHAT_RATE", 1)           # сообщений/сек в один личный чат
+    cfg.setdefault("SEND_CHAT_BURST", 3)
+    cfg.setdefault("SEND_GROUP_RATE", 20)         # сообщений/мин в одну группу
+    cfg.setdefault("SEND_WORKERS", 8)
+    cfg.setdefault("LIMIT_UPLOAD_PER_MIN", 20)    # загрузок (файл или альбом) в минуту на пользователя, 0 — без лимита
+    cfg.setdefault("LIMIT_UPLOAD_BURST", 10)
+    cfg.setdefault("LIMIT_PAY_PER_MIN", 2)        # /pay в минуту на пользователя
+    cfg.setdefault("LIMIT_PAY_BURST", 3)
+    cfg.setdefault("LIMIT_CHECK_PER_MIN", 6)      # «Проверить оплату» в минуту на пользователя
+    cfg.setdefault("LIMIT_CHECK_BURST", 3)
+    cfg.setdefault("LIMIT_MAX_USERS", 100000)     # пользователей в памяти на каждый лимит
+    cfg.setdefault("METRICS_LISTEN", "127.0.0.1")
+    cfg.setdefault("METRICS_PORT", 0)             # Prometheus /metrics, 0 — выключено
+    cfg.setdefault("PROFILER_INTERVAL_MS", 10)
+    cfg.setdefault("MODE", "polling")             # polling | webhook
+    cfg.setdefault("ENGINE", "sync")              # sync (потоки) | async (asyncio, нужен aiohttp)
+    cfg.setdefault("ASYNC_MAX_IN_FLIGHT", 5000)   # апдейтов одновременно в обработке при ENGINE=async
+    cfg.setdefault("WEBHOOK_URL", "")             # публичный https-адрес, напр. https://bot.example.com
+    cfg.setdefault("WEBHOOK_LISTEN", "0.0.0.0")
+    cfg.setdefault("WEBHOOK_PORT", 8080)
+    cfg.setdefault("WEBHOOK_SECRET", "")          # X-Telegram-Bot-Api-Secret-Token, обязателен для MODE=webhook
+    cfg.setdefault("WEBHOOK_TG_PATH", "/telegram")
+    cfg.setdefault("WEBHOOK_CRYPTOPAY_PATH", "/cryptopay")
+    cfg.setdefault("WEBHOOK_WORKERS", 8)
+    cfg.setdefault("WEBHOOK_QUEUE", 1000)         # всего ожидающих апдейтов, сверх — 503
+    cfg.setdefault("FILE_CACHE_SIZE", 2048)       # горячих записей файлов в памяти
+    cfg.setdefault("FILE_CACHE_TTL", 300)         # сек, после — перечитать из БД
+    cfg.setdefault("SEARCH_PAGE", 20)             # результатов инлайн-поиска за раз (до 50)
+    cfg.setdefault("SEARCH_CACHE_SIZE", 1024)     # запросов поиска в кеше
+    cfg.setdefault("SEARCH_CACHE_TTL", 60)        # сек
+    cfg.setdefault("INLINE_CACHE_TIME", 10)       # сек, cache_time ответа инлайн-запроса в Telegram
+    cfg.setdefault("STATS_FLUSH_INTERVAL", 60)    # сек между сбросами счётчиков скачиваний в БД
+    cfg.setdefault("SNAPSHOT_INTERVAL", 600)      # сек между снапшотами БД в CHANNEL_ID, 0 — выключено
+    cfg.setdefault("SNAPSHOT_MAX_DELTAS", 24)     # дельт до следующего полного снапшота
+    cfg.setdefault("SNAPSHOT_PART_MB", 19)        # снапшот режется на файлы до стольких МБ (getFile: до 20 МБ)
+    cfg.setdefault("SWEEP_INTERVAL", 3600)        # сек между проходами архиватора
+    cfg.setdefault("ARCHIVE_DIR", "archive")
+    cfg.setdefault("INVOICE_EXPIRED_KEEP_HOURS", 24)  # истёкшие счета в архив через столько часов
+    cfg.setdefault("INVOICE_PAID_KEEP_DAYS", 30)      # оплаченные — через столько дней после зачисления
+    cfg.setdefault("FILE_RETENTION_DAYS", 0)          # файлы старше — в архив, 0 — хранить всегда
+    cfg.setdefault("STATS_KEEP_DAYS", 30)             # дневные счётчики старше — в архив (итоги остаются), 0 — хранить всегда
+    cfg.setdefault("WORKERS", 1)                  # процессов-обработчиков, больше 1 — только со STORAGE=sqlite
+
+    if cfg["STORAGE"] not in ("json", "sqlite"):
+        raise SystemExit("❌ STORAGE в config.json: json или sqlite")
+    if cfg["DEDUP_POLICY"] not in ("alias", "link", "off"):
+        raise SystemExit("❌ DEDUP_POLICY в config.json: alias, link или off")
+    if cfg["MODE"] not in ("polling", "webhook"):
+        raise SystemExit("❌ MODE в config.json: polling или webhook")
+    if cfg["MODE"] == "webhook" and not re.fullmatch(r"[A-Za-z0-9_-]{16,256}", str(cfg["WEBHOOK_SECRET"])):
+        # without it anyone who reaches the port can post updates as ADMIN_ID
+        raise SystemExit("❌ MODE=webhook требует WEBHOOK_SECRET: 16–256 символов A-Z, a-z, 0-9, _ и -")
+    if int(cfg["WORKERS"]) > 1 and cfg["STORAGE"] != "sqlite":
+        raise SystemExit("❌ WORKERS > 1 работает только со STORAGE=sqlite")
+    if not 1 <= int(cfg["BACKUP_QUORUM"]) <= len(channels):
+        raise SystemExit(f"❌ BACKUP_QUORUM в config.json: от 1 до {len(channels)} (число CHANNEL_ID)")
+    if cfg["ENGINE"] not in ("sync", "async"):
+        raise SystemExit("❌ ENGINE в config.json: sync или async")
+    if cfg["ENGINE"] == "async" and int(cfg["WORKERS"]) > 1:
+        raise SystemExit("❌ ENGINE=async работает в одном процессе (WORKERS=1)")
+    if cfg["ENGINE"] == "async" and aiohttp is None:
+        raise SystemExit("❌ ENGINE=async требует aiohttp: pip install aiohttp")
 
     return cfg
 
@@ -49,12 +168,80 @@ config = load_config()
 
 TOKEN = str(config["TOKEN"])
 ADMIN_ID = int(config["ADMIN_ID"])
-CHANNEL_ID = str(config["CHANNEL_ID"]).strip()
+CHANNEL_IDS = config["CHANNEL_ID"]
+CHANNEL_ID = CHANNEL_IDS[0]  # primary: database snapshots go here
+BACKUP_QUORUM = int(config["BACKUP_QUORUM"])
+BACKUP_WORKERS = max(1, int(config["BACKUP_WORKERS"]))
+BACKUP_RETRY_BASE = max(0.1, float(config["BACKUP_RETRY_BASE"]))
+BACKUP_RETRY_MAX = max(BACKUP_RETRY_BASE, float(config["BACKUP_RETRY_MAX"]))
+BACKUP_MAX_ATTEMPTS = max(1, int(config["BACKUP_MAX_ATTEMPTS"]))
+BACKUP_LEASE = max(10.0, float(config["BACKUP_LEASE"]))
+BACKUP_POLL = max(0.1, float(config["BACKUP_POLL"]))
 CRYPTOPAY_TOKEN = str(config["CRYPTOPAY_TOKEN"])
 CRYPTOPAY_BASE = str(config.get("CRYPTOPAY_BASE", "https://pay.crypt.bot/api/")).rstrip("/") + "/"
+TELEGRAM_API_URL = str(config["TELEGRAM_API_URL"]).rstrip("/")
 DEFAULT_PRICE_USD = float(config.get("DEFAULT_PRICE_USD", 0.5))
+CRYPTOPAY_TIMEOUT = tuple(float(x) for x in config["CRYPTOPAY_TIMEOUT"])
+CRYPTOPAY_RETRIES = max(0, int(config["CRYPTOPAY_RETRIES"]))
+CRYPTOPAY_POOL_SIZE = max(1, int(config["CRYPTOPAY_POOL_SIZE"]))
+CRYPTOPAY_BREAKER_THRESHOLD = max(1, int(config["CRYPTOPAY_BREAKER_THRESHOLD"]))
+CRYPTOPAY_BREAKER_COOLDOWN = float(config["CRYPTOPAY_BREAKER_COOLDOWN"])
+DB_FLUSH_INTERVAL = max(0.1, float(config.get("DB_FLUSH_INTERVAL", 2.0)))
+DB_FLUSH_MAX_PENDING = max(1, int(config.get("DB_FLUSH_MAX_PENDING", 500)))
+STORAGE = str(config["STORAGE"])
+SQLITE_PATH = str(config["SQLITE_PATH"])
+COMPACT_RECORDS = bool(config["COMPACT_RECORDS"])
+RECONCILE_INTERVAL = max(1.0, float(config["RECONCILE_INTERVAL"]))
+RECONCILE_BATCH = min(1000, max(1, int(config["RECONCILE_BATCH"])))
+DEDUP_POLICY = str(config["DEDUP_POLICY"])
+ALBUM_WINDOW = max(0.1, float(config["ALBUM_WINDOW"]))
+SEND_GLOBAL_RATE = float(config["SEND_GLOBAL_RATE"]) / max(1, int(config["WORKERS"]))  # per process
+SEND_CHAT_RATE = float(config["SEND_CHAT_RATE"])
+SEND_CHAT_BURST = max(1, int(config["SEND_CHAT_BURST"]))
+SEND_GROUP_RATE = float(config["SEND_GROUP_RATE"]) / 60
+LIMIT_MAX_USERS = max(1, int(config["LIMIT_MAX_USERS"]))
+SEND_WORKERS = max(1, int(config["SEND_WORKERS"]))
+METRICS_LISTEN = str(config["METRICS_LISTEN"])
+METRICS_PORT = int(config["METRICS_PORT"])
+PROFILER_INTERVAL_MS = max(1, int(config["PROFILER_INTERVAL_MS"]))
+MODE = str(config["MODE"])
+ENGINE = str(config["ENGINE"])
+ASYNC_MAX_IN_FLIGHT = max(1, int(config["ASYNC_MAX_IN_FLIGHT"]))
+WEBHOOK_URL = str(config["WEBHOOK_URL"]).rstrip("/")
+WEBHOOK_LISTEN = str(config["WEBHOOK_LISTEN"])
+WEBHOOK_PORT = int(config["WEBHOOK_PORT"])
+WEBHOOK_SECRET = str(config["WEBHOOK_SECRET"])
+WEBHOOK_TG_PATH = str(config["WEBHOOK_TG_PATH"])
+WEBHOOK_CRYPTOPAY_PATH = str(config["WEBHOOK_CRYPTOPAY_PATH"])
+WEBHOOK_WORKERS = max(1, int(config["WEBHOOK_WORKERS"]))
+WEBHOOK_QUEUE = max(WEBHOOK_WORKERS, int(config["WEBHOOK_QUEUE"]))
+FILE_CACHE_SIZE = max(0, int(config["FILE_CACHE_SIZE"]))
+FILE_CACHE_TTL = max(1.0, float(config["FILE_CACHE_TTL"]))
+SEARCH_PAGE = min(50, max(1, int(config["SEARCH_PAGE"])))
+SEARCH_CACHE_SIZE = max(0, int(config["SEARCH_CACHE_SIZE"]))
+SEARCH_CACHE_TTL = max(1.0, float(config["SEARCH_CACHE_TTL"]))
+INLINE_CACHE_TIME = max(0, int(config["INLINE_CACHE_TIME"]))
+STATS_FLUSH_INTERVAL = max(1.0, float(config["STATS_FLUSH_INTERVAL"]))
+SNAPSHOT_INTERVAL = max(0.0, float(config["SNAPSHOT_INTERVAL"]))
+SNAPSHOT_MAX_DELTAS = min(40, max(1, int(config["SNAPSHOT_MAX_DELTAS"])))  # the manifest must fit one message
+SNAPSHOT_PART_BYTES = int(max(1.0, float(config["SNAPSHOT_PART_MB"])) * 1024 * 1024)
+SWEEP_INTERVAL = max(60.0, float(config["SWEEP_INTERVAL"]))
+ARCHIVE_DIR = str(config["ARCHIVE_DIR"])
+INVOICE_EXPIRED_KEEP_HOURS = max(0.0, float(config["INVOICE_EXPIRED_KEEP_HOURS"]))
+INVOICE_PAID_KEEP_DAYS = max(0.0, float(config["INVOICE_PAID_KEEP_DAYS"]))
+FILE_RETENTION_DAYS = max(0.0, float(config["FILE_RETENTION_DAYS"]))
+STATS_KEEP_DAYS = max(0.0, float(config["STATS_KEEP_DAYS"]))
+WORKERS = max(1, int(config["WORKERS"]))
+SHARED_DB = WORKERS > 1  # several processes write the same SQLite file
 
-bot = telebot.TeleBot(TOKEN, parse_mode="HTML")
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
+# in webhook and multi-process mode handlers run on our own worker pool, not
+# telebot's; with ENGINE=async this bot only serves background threads
+bot = telebot.TeleBot(TOKEN, parse_mode="HTML", threaded=(MODE != "webhook" and WORKERS == 1 and ENGINE == "sync"))
+abot = None  # AsyncTeleBot, ENGINE=async
 
 # =======================
 # TIME
@@ -65,6 +252,7 @@ def now_utc():
 def dt_to_iso(dt: datetime | None):
     return dt.astimezone(timezone.utc).isoformat() if dt else None
 
+@functools.lru_cache(maxsize=65536)  # sub_until is checked on every upload
 def iso_to_dt(s: str | None):
     if not s:
         return None
@@ -73,21 +261,889 @@ def iso_to_dt(s: str | None):
     except Exception:
         return None
 
+# =======================
+# METRICS
+# =======================
+# In-process counters/histograms rendered in Prometheus text format on
+# METRICS_LISTEN:METRICS_PORT and summarized by the admin /metrics command.
+# Handlers are wrapped with @instrumented, Telegram API calls are timed via
+# apihelper.CUSTOM_REQUEST_SENDER, Crypto Pay calls in crypto_request().
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: dict = {}   # (name, labels) -> value
+        self.gauges: dict = {}
+        self.hists: dict = {}      # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self.help: dict = {}
+        self.collectors = []       # callables run before render() to refresh gauges
+
+    def describe(self, name: str, kind: str, text: str):
+        self.help[name] = (kind, text)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def set(self, name: str, value: float, labels: tuple = ()):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name: str, seconds: float, labels: tuple = ()):
+        with self.lock:
+            h = self.hists.get((name, labels))
+            if h is None:
+                h = self.hists[(name, labels)] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            h[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            h[-1] += seconds
+
+    def quantile(self, name: str, labels: tuple, q: float) -> float:
+        # upper bound of the bucket holding the q-quantile
+        with self.lock:
+            h = self.hists.get((name, labels))
+            if not h:
+                return 0.0
+            counts = h[:-1]
+        need = q * sum(counts)
+        acc = 0
+        for i, c in enumerate(counts):
+            acc += c
+            if acc >= need and c:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return 0.0
+
+    def hist_summary(self, name: str) -> dict:
+        # labels -> (count, sum)
+        with self.lock:
+            return {labels: (sum(h[:-1]), h[-1]) for (n, labels), h in self.hists.items() if n == name}
+
+    def counter_values(self, name: str) -> dict:
+        with self.lock:
+            return {labels: v for (n, labels), v in self.counters.items() if n == name}
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                print(f"metrics collector failed: {e}")
+        out = []
+        with self.lock:
+            seen = set()
+
+            def header(name, default_kind):
+                if name not in seen:
+                    seen.add(name)
+                    kind, text = self.help.get(name, (default_kind, name))
+                    out.append(f"# HELP {name} {text}")
+                    out.append(f"# TYPE {name} {kind}")
+
+            for (name, labels), v in sorted(self.counters.items()):
+                header(name, "counter")
+                out.append(f"{name}{self._labels(labels)} {v}")
+            for (name, labels), v in sorted(self.gauges.items()):
+                header(name, "gauge")
+                out.append(f"{name}{self._labels(labels)} {v}")
+            for (name, labels), h in sorted(self.hists.items()):
+                header(name, "histogram")
+                acc = 0
+                for bound, c in zip((*LATENCY_BUCKETS, "+Inf"), h[:-1]):
+                    acc += c
+                    le = 'le="%s"' % bound
+                    out.append(f"{name}_bucket{self._labels(labels, le)} {acc}")
+                out.append(f"{name}_sum{self._labels(labels)} {h[-1]}")
+                out.append(f"{name}_count{self._labels(labels)} {acc}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "histogram", "Update handler latency")
+metrics.describe("bot_handler_errors_total", "counter", "Update handlers that raised")
+metrics.describe("bot_handlers_in_flight", "gauge", "Update handlers running now")
+metrics.describe("telegram_api_seconds", "histogram", "Telegram Bot API call latency")
+metrics.describe("telegram_api_errors_total", "counter", "Failed Telegram Bot API calls")
+metrics.describe("cryptopay_api_seconds", "histogram", "Crypto Pay API call latency")
+metrics.describe("cryptopay_api_errors_total", "counter", "Failed Crypto Pay API attempts")
+metrics.describe("cryptopay_api_retries_total", "counter", "Retried Crypto Pay API attempts")
+metrics.describe("db_flush_seconds", "histogram", "Time to persist pending DB changes")
+metrics.describe("db_size_bytes", "gauge", "Size of the database on disk")
+metrics.describe("snapshot_uploads_total", "counter", "Database snapshots sent to the backup channel")
+metrics.describe("snapshot_bytes_total", "counter", "Compressed bytes of database snapshots sent")
+metrics.describe("file_cache_total", "counter", "Hot file record lookups by result")
+metrics.describe("archive_records_total", "counter", "Records moved from the database to the archive")
+metrics.describe("archive_reclaimed_bytes_total", "counter", "Serialized bytes removed from the database by the sweeper")
+
+_in_flight = [0]
+_in_flight_lock = threading.Lock()
+_thread_loop = threading.local()
+
+def run_sync(coro):
+    # ENGINE=sync: drive a coroutine handler to completion on this thread's own loop
+    loop = getattr(_thread_loop, "loop", None)
+    if loop is None:
+        loop = _thread_loop.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coro)
+
+def instrumented(fn):
+    # Handlers are coroutines shared by both engines: telebot.TeleBot gets a
+    # plain function that runs one via run_sync(), AsyncTeleBot the coroutine
+    # itself (wrapper.run_async).
+    labels = (("handler", fn.__name__),)
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def run_async(*args, **kwargs):
+            with _in_flight_lock:
+                _in_flight[0] += 1
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                metrics.inc("bot_handler_errors_total", labels)
+                raise
+            finally:
+                metrics.observe("bot_handler_seconds", time.perf_counter() - t0, labels)
+                with _in_flight_lock:
+                    _in_flight[0] -= 1
+
+        @functools.wraps(fn)
+        def sync_wrapper(*args, **kwargs):
+            return run_sync(run_async(*args, **kwargs))
+        sync_wrapper.run_async = run_async
+        return sync_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _in_flight_lock:
+            _in_flight[0] += 1
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - t0, labels)
+            with _in_flight_lock:
+                _in_flight[0] -= 1
+    return wrapper
+
+metrics.collectors.append(lambda: metrics.set("bot_handlers_in_flight", _in_flight[0]))
+
+tg_session = requests.Session()
+tg_session.mount("https://", HTTPAdapter(pool_maxsize=32, max_retries=0))
+tg_session.mount("http://", HTTPAdapter(pool_maxsize=32, max_retries=0))
+
+def _tg_request_sender(method, url, **kwargs):
+    labels = (("method", url.rsplit("/", 1)[-1]),)  # never the URL: it contains the token
+    t0 = time.perf_counter()
+    try:
+        r = tg_session.request(method, url, **kwargs)
+    except Exception:
+        metrics.inc("telegram_api_errors_total", labels)
+        raise
+    finally:
+        metrics.observe("telegram_api_seconds", time.perf_counter() - t0, labels)
+    if r.status_code >= 400:
+        metrics.inc("telegram_api_errors_total", labels)
+    return r
+
+apihelper.CUSTOM_REQUEST_SENDER = _tg_request_sender
+
+def start_metrics_server():
+    if not METRICS_PORT:
+        return
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    server = ThreadingHTTPServer((METRICS_LISTEN, METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+
+# Opt-in sampling profiler (/profile on|off): every PROFILER_INTERVAL_MS it
+# records the stacks of all other threads; /profile dumps the hottest ones.
+_profile_samples: Counter = Counter()
+# innermost frames of threads parked on a lock/queue/socket: not worth sampling
+_IDLE_FRAMES = {"wait", "get", "select", "_worker", "serve_forever", "_wait_for_tstate_lock", "accept", "readinto"}
+_profile_stop = threading.Event()
+_profile_thread = None
+
+def _profiler_loop(interval: float):
+    me = threading.get_ident()
+    while not _profile_stop.wait(interval):
+        for tid, frame in sys._current_frames().items():
+            if tid == me or frame.f_code.co_name in _IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None and len(stack) < 24:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            _profile_samples[tuple(reversed(stack))] += 1
+
+def profiler_start() -> bool:
+    global _profile_thread
+    if _profile_thread and _profile_thread.is_alive():
+        return False
+    _profile_samples.clear()
+    _profile_stop.clear()
+    _profile_thread = threading.Thread(
+        target=_profiler_loop, args=(PROFILER_INTERVAL_MS / 1000,), name="profiler", daemon=True
+    )
+    _profile_thread.start()
+    return True
+
+def profiler_stop():
+    _profile_stop.set()
+
+def profiler_report(top: int = 20) -> str:
+    samples = _profile_samples.copy()
+    total = sum(samples.values()) or 1
+    lines = [f"samples: {total}, interval: {PROFILER_INTERVAL_MS} ms"]
+    for stack, n in samples.most_common(top):
+        lines.append(f"\n{n} ({n * 100 / total:.1f}%)")
+        lines.extend("  " + frame for frame in stack)
+    return "\n".join(lines)
+
 # =======================
 # DB (auto-create + migration)
 # =======================
+# save_db() only marks the state dirty; a background thread writes compact JSON
+# every DB_FLUSH_INTERVAL seconds (or sooner after DB_FLUSH_MAX_PENDING changes)
+# via temp file + rename. Every mutation of `db` must happen under db_tx()
+# (db_tx(immediate=False) for writes that don't depend on what they read).
+db_lock = threading.RLock()
+_flush_lock = threading.Lock()
+_flush_wakeup = threading.Event()
+_db_pending = 0
+_tx_depth = 0
+
+def _write_db_file(data: str):
+    tmp = DB_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, DB_PATH)
+
+def _db_file_stamp():
+    try:
+        st = os.stat(DB_PATH)
+        return [st.st_mtime_ns, st.st_size]
+    except OSError:
+        return None
+
+def _dump_db(db) -> str:
+    return json.dumps(db, ensure_ascii=False, separators=(",", ":"))
+
+def _copy_db(db) -> dict:
+    # consistent view to serialize outside db_lock: stored records are never
+    # changed in place (sections hand out copies), so shallow copies do
+    return {name: section.copy() if isinstance(section, dict) else section for name, section in db.items()}
+
+_changed: set = set()  # (section, key) written since the last snapshot, JSON storage
+
+class TrackedDict(dict):
+    # a JSON section that remembers written/deleted keys for the snapshotter.
+    # Like SqlTable, reads return copies of the records: after changing one,
+    # assign it back.
+    def __init__(self, section: str, data: dict):
+        super().__init__(data)
+        self.section = section
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        return dict(value) if type(value) is dict else value
+
+    def get(self, key, default=None):
+        value = super().get(key, default)
+        return dict(value) if type(value) is dict and value is not default else value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if SNAPSHOT_INTERVAL:
+            _changed.add((self.section, key))
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        if SNAPSHOT_INTERVAL:
+            _changed.add((self.section, key))
+
+# Compact records (STORAGE=json, COMPACT_RECORDS): files and users are kept
+# as __slots__ objects instead of dicts, timestamps as epoch ints and
+# repeated strings (mime_type, backup_chat, u_tag, ...) interned. Like
+# SqlTable, the section hands out fresh dicts in the usual schema and packs
+# them again on write, so the rest of the code doesn't change. A value that
+# wouldn't come back exactly (another date format, an unknown key) is kept
+# as it is.
+_MISSING = object()
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_US = timedelta(microseconds=1)
+
+def _intern(v):
+    return sys.intern(v) if isinstance(v, str) else v
+
+# pack functions raise ValueError (or TypeError) for a value they can't hold
+# (it goes to _extra) and return strings they don't recognize unchanged
+def _pack_minute(v):
+    # "2025-01-01 12:30 UTC" (file created_at) -> epoch seconds
+    if isinstance(v, int):
+        raise ValueError(v)
+    return _minute_epoch(v) if isinstance(v, str) else v  # only strings are hashable for sure
+
+@functools.lru_cache(maxsize=1 << 16)  # files uploaded in the same minute
+def _minute_epoch(v: str):
+    if len(v) != 20 or not v.endswith(" UTC"):
+        return v
+    try:
+        dt = datetime(int(v[:4]), int(v[5:7]), int(v[8:10]), int(v[11:13]), int(v[14:16]), tzinfo=timezone.utc)
+    except ValueError:
+        return v
+    if dt.strftime("%Y-%m-%d %H:%M UTC") != v:
+        return v
+    return (dt - _EPOCH) // timedelta(seconds=1)
+
+def _unpack_minute(v):
+    return _minute_text(v) if isinstance(v, int) else v
+
+@functools.lru_cache(maxsize=1 << 16)
+def _minute_text(v: int) -> str:
+    return (_EPOCH + timedelta(seconds=v)).strftime("%Y-%m-%d %H:%M UTC")
+
+def _pack_iso(v):
+    # dt_to_iso() string (users' sub_until, last_seen) -> epoch microseconds
+    if isinstance(v, int):
+        raise ValueError(v)
+    dt = iso_to_dt(v) if isinstance(v, str) else None
+    if dt is None or dt.utcoffset() != timedelta(0) or dt.isoformat() != v:
+        return v
+    return (dt - _EPOCH) // _US
+
+def _unpack_iso(v):
+    return (_EPOCH + v * _US).isoformat() if isinstance(v, int) else v
+
+def _pack_replicas(v):
+    if not isinstance(v, list) or not all(isinstance(r, dict) and r.keys() == {"chat", "msg_id", "file_id"} for r in v):
+        return v
+    return tuple((_intern(r["chat"]), r["msg_id"], r["file_id"]) for r in v)
+
+def _unpack_replicas(v):
+    return [{"chat": c, "msg_id": m, "file_id": f} for c, m, f in v] if isinstance(v, tuple) else v
+
+class CompactRecord:
+    # FIELDS are slots named like the JSON keys; PACK maps a field to
+    # (pack, unpack), unpack None = stored as is; other keys go to _extra
+    __slots__ = ("_extra",)
+    FIELDS: tuple = ()
+    PACK: dict = {}
+
+    def __init_subclass__(cls):
+        cls.KEYS = frozenset(cls.FIELDS)
+        cls.VALUES = operator.attrgetter(*cls.FIELDS)
+        cls.SLOTS = tuple((k, cls.PACK[k][0] if k in cls.PACK else None) for k in cls.FIELDS)
+        cls.UNPACK = tuple((k, unpack) for k, (_, unpack) in cls.PACK.items() if unpack)
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        rec = cls.__new__(cls)
+        extra = {} if cls.KEYS.issuperset(d) else {k: v for k, v in d.items() if k not in cls.KEYS}
+        get = d.get
+        for k, pack in cls.SLOTS:
+            v = get(k, _MISSING)
+            if pack is not None and v is not _MISSING:
+                try:
+                    v = pack(v)
+                except (ValueError, TypeError):
+                    extra[k] = v
+                    v = _MISSING
+            setattr(rec, k, v)
+        rec._extra = extra or None
+        return rec
+
+    def to_dict(self) -> dict:
+        d = {k: v for k, v in zip(self.FIELDS, self.VALUES(self)) if v is not _MISSING}
+        for k, unpack in self.UNPACK:
+            if k in d:
+                d[k] = unpack(d[k])
+        if self._extra:
+            d.update(self._extra)
+        return d
+
+class FileRecord(CompactRecord):
+    FIELDS = ("file_id", "file_unique_id", "file_name", "mime_type", "u_id", "u_tag", "created_at",
+              "backup_chat", "backup_msg_id", "replicas", "alias_of")
+    __slots__ = FIELDS
+    PACK = {
+        "mime_type": (_intern, None),
+        "u_tag": (_intern, None),
+        "backup_chat": (_intern, None),
+        "created_at": (_pack_minute, _unpack_minute),
+        "replicas": (_pack_replicas, _unpack_replicas),
+    }
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        rec = super().from_dict(d)
+        if isinstance(rec.replicas, tuple):
+            # the first copy usually has the record's own file_id: share the string
+            rec.replicas = tuple((c, m, rec.file_id if f == rec.file_id else f) for c, m, f in rec.replicas)
+        return rec
+
+class UserRecord(CompactRecord):
+    FIELDS = ("id", "username", "tag", "first_name", "last_name", "last_seen", "sub_until", "last_invoice")
+    __slots__ = FIELDS
+    PACK = {
+        "first_name": (_intern, None),
+        "last_name": (_intern, None),
+        "last_seen": (_pack_iso, _unpack_iso),
+        "sub_until": (_pack_iso, _unpack_iso),
+    }
+
+class CompactSection(TrackedDict):
+    # values are CompactRecords; reads return fresh dicts (assign back after a change)
+    def __init__(self, section: str, data: dict, record_cls):
+        self.record_cls = record_cls
+        for key, value in data.items():
+            if not isinstance(value, record_cls):
+                data[key] = record_cls.from_dict(value)
+        super().__init__(section, data)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key).to_dict()
+
+    def get(self, key, default=None):
+        rec = dict.get(self, key)
+        return default if rec is None else rec.to_dict()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, self.record_cls.from_dict(value))
+
+    def copy(self):
+        # the same records in a new section, for serializing outside db_lock
+        view = CompactSection.__new__(CompactSection)
+        dict.update(view, self)
+        view.section, view.record_cls = self.section, self.record_cls
+        return view
+
+    def items(self):
+        return ((k, rec.to_dict()) for k, rec in dict.items(self))
+
+    def values(self):
+        return (rec.to_dict() for rec in dict.values(self))
+
+COMPACT_SECTIONS = {"files": FileRecord, "users": UserRecord}
+
+def json_section(name: str, data: dict) -> TrackedDict:
+    if COMPACT_RECORDS and name in COMPACT_SECTIONS:
+        return CompactSection(name, data, COMPACT_SECTIONS[name])
+    return TrackedDict(name, data)
+
 def save_db(db):
-    with open(DB_PATH, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
+    global _db_pending
+    with db_lock:
+        _db_pending += 1
+        if SHARED_DB or _db_pending >= DB_FLUSH_MAX_PENDING:
+            _flush_wakeup.set()  # other processes only see committed rows
+
+@contextmanager
+def db_tx(immediate: bool = True):
+    # With WORKERS > 1 the block runs in an IMMEDIATE SQLite transaction, so a
+    # record read here can't be overwritten by another process before we write
+    # it back (e.g. the reconciler crediting a sub while a worker updates the
+    # same user). Blind writes (immediate=False) don't commit their own: they go
+    # to a savepoint of this process's open batch, which the flusher commits
+    # right after, along with the other blind writes made meanwhile (the batch
+    # still starts IMMEDIATE: a deferred one that has read can't write once
+    # another process commits). Otherwise it is just db_lock.
+    global _db_pending, _tx_depth
+    with db_lock:
+        outer = SHARED_DB and not _tx_depth
+        if outer:
+            if immediate:
+                if sql_conn.in_transaction:
+                    sql_conn.commit()
+                sql_conn.execute("BEGIN IMMEDIATE")
+            else:
+                if not sql_conn.in_transaction:
+                    sql_conn.execute("BEGIN IMMEDIATE")
+                sql_conn.execute("SAVEPOINT blind")
+        _tx_depth += 1
+        try:
+            yield
+        except BaseException:
+            if outer and immediate:
+                sql_conn.rollback()
+            elif outer:
+                sql_conn.execute("ROLLBACK TO blind")
+                sql_conn.execute("RELEASE blind")
+            raise
+        finally:
+            _tx_depth -= 1
+        if outer and immediate:
+            sql_conn.commit()
+            _db_pending = 0
+        elif outer:
+            sql_conn.execute("RELEASE blind")
+
+def flush_db() -> bool:
+    global _db_pending
+    if STORAGE == "sqlite":
+        with db_lock:
+            if not _db_pending:
+                return False
+            t0 = time.perf_counter()
+            sql_conn.commit()
+            _db_pending = 0
+        metrics.observe("db_flush_seconds", time.perf_counter() - t0)
+        return True
+
+    with _flush_lock:
+        t0 = time.perf_counter()
+        with db_lock:
+            if not _db_pending:
+                return False
+            pending = _db_pending
+            view = _copy_db(db)
+            _db_pending = 0
+        try:
+            _write_db_file(_dump_db(view))
+        except Exception:
+            with db_lock:
+                _db_pending += pending
+            raise
+        metrics.observe("db_flush_seconds", time.perf_counter() - t0)
+    return True
+
+def db_size_bytes() -> int:
+    if STORAGE == "sqlite":
+        with db_lock:
+            pages = sql_conn.execute("PRAGMA page_count").fetchone()[0]
+            page_size = sql_conn.execute("PRAGMA page_size").fetchone()[0]
+        return pages * page_size
+    try:
+        return os.path.getsize(DB_PATH)
+    except OSError:
+        return 0
+
+metrics.collectors.append(lambda: metrics.set("db_size_bytes", db_size_bytes()))
+
+def _db_flusher():
+    while True:
+        _flush_wakeup.wait(DB_FLUSH_INTERVAL)
+        _flush_wakeup.clear()
+        try:
+            flush_db()
+        except Exception as e:
+            print(f"DB flush failed: {e}")
+
+def start_db_flusher():
+    threading.Thread(target=_db_flusher, name="db-flusher", daemon=True).start()
+    atexit.register(flush_db)
+
+# =======================
+# SQLITE STORAGE (STORAGE=sqlite)
+# =======================
+# Each section of `db` becomes a table with the record kept as JSON in `data`
+# plus a few indexed columns. Writes go into an open transaction which
+# flush_db() commits, so save_db() batching works the same as for JSON.
+# Records are returned as fresh dicts: after changing one, assign it back.
+SQL_TABLES = {
+    # section: (key column, {column: (sql type, record field)})
+    "files": ("code", {"u_id": ("INTEGER", "u_id"), "file_unique_id": ("TEXT", "file_unique_id")}),
+    "users": ("id", {
+        "uid": ("INTEGER", "id"),
+        "username": ("TEXT COLLATE NOCASE", "username"),
+        "sub_until": ("TEXT", "sub_until"),
+    }),
+    "invoices": ("invoice_id", {"status": ("TEXT", "status"), "user_id": ("INTEGER", "user_id")}),
+    "settings": ("key", {}),
+    "stats": ("key", {
+        "code": ("TEXT", "code"),
+        "day": ("TEXT", "day"),
+        "u_id": ("INTEGER", "u_id"),
+        "views": ("INTEGER", "views"),
+        "downloads": ("INTEGER", "downloads"),
+    }),
+    "backups": ("code", {"due": ("REAL", "due")}),  # backup queue, see BACKUP QUEUE
+    "backups_failed": ("code", {}),  # backup jobs given up after BACKUP_MAX_ATTEMPTS
+}
+
+sql_conn = None
+
+class SqlTable(MutableMapping):
+    def __init__(self, conn, name: str):
+        self.conn = conn
+        self.name = name
+        self.key_col, self.cols = SQL_TABLES[name]
+        names = [self.key_col, *self.cols, "data"]
+        self._insert_sql = (
+            f"INSERT OR REPLACE INTO {name} ({', '.join(names)}) "
+            f"VALUES ({', '.join('?' * len(names))})"
+        )
+
+    def __getitem__(self, key):
+        with db_lock:
+            row = self.conn.execute(
+                f"SELECT data FROM {self.name} WHERE {self.key_col} = ?", (str(key),)
+            ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        extra = [value.get(field) if isinstance(value, dict) else None for _, field in self.cols.values()]
+        with db_lock:
+            self.conn.execute(self._insert_sql, (str(key), *extra, json.dumps(value, ensure_ascii=False)))
+            self._log_change(key)
+
+    def __delitem__(self, key):
+        with db_lock:
+            cur = self.conn.execute(f"DELETE FROM {self.name} WHERE {self.key_col} = ?", (str(key),))
+            if cur.rowcount:
+                self._log_change(key)
+        if not cur.rowcount:
+            raise KeyError(key)
+
+    def _log_change(self, key):
+        if SNAPSHOT_INTERVAL:
+            self.conn.execute("INSERT INTO changes (section, key) VALUES (?, ?)", (self.name, str(key)))
+
+    def __contains__(self, key):
+        with db_lock:
+            return self.conn.execute(
+                f"SELECT 1 FROM {self.name} WHERE {self.key_col} = ?", (str(key),)
+            ).fetchone() is not None
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        for key, _ in self.rows():
+            yield key
+
+    def items(self):
+        return ((k, json.loads(d)) for k, d in self.rows())
+
+    def values(self):
+        return (json.loads(d) for _, d in self.rows())
+
+    def count(self, where: str = "", params=()) -> int:
+        with db_lock:
+            return self.conn.execute(
+                f"SELECT COUNT(*) FROM {self.name} {'WHERE ' + where if where else ''}", params
+            ).fetchone()[0]
+
+    def rows(self, where: str = "", params=(), order: str = "", limit: int | None = None, offset: int = 0,
+             batch: int = 1000):
+        # streams (key, json) in batches; the lock is only held while fetching
+        sql = f"SELECT {self.key_col}, data FROM {self.name}"
+        if where:
+            sql += " WHERE " + where
+        if order:
+            sql += " ORDER BY " + order
+        if limit is not None or offset:
+            sql += f" LIMIT {-1 if limit is None else int(limit)} OFFSET {int(offset)}"
+        with db_lock:
+            cur = self.conn.execute(sql, params)
+        while True:
+            with db_lock:
+                chunk_rows = cur.fetchmany(batch)
+            if not chunk_rows:
+                return
+            yield from chunk_rows
+
+    def find(self, where: str, params=(), order: str = "", limit: int | None = None, offset: int = 0):
+        return ((k, json.loads(d)) for k, d in self.rows(where, params, order, limit, offset))
+
+    def select(self, cols: str, where: str = "", params=(), tail: str = "") -> list[tuple]:
+        # raw column query, e.g. aggregates: select("code, SUM(views)", tail="GROUP BY code")
+        with db_lock:
+            return self.conn.execute(
+                f"SELECT {cols} FROM {self.name} {'WHERE ' + where if where else ''} {tail}", params
+            ).fetchall()
+
+def _create_sql_schema(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, section TEXT, key TEXT)")
+    for name, (key_col, cols) in SQL_TABLES.items():
+        col_defs = "".join(f", {c} {t}" for c, (t, _) in cols.items())
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {name} ({key_col} TEXT PRIMARY KEY{col_defs}, data TEXT NOT NULL)")
+        have = {r[1] for r in conn.execute(f"PRAGMA table_info({name})")}
+        for c, (t, field) in cols.items():
+            if c not in have:
+                conn.execute(f"ALTER TABLE {name} ADD COLUMN {c} {t}")
+                conn.execute(f"UPDATE {name} SET {c} = json_extract(data, '$.{field}')")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_{c} ON {name} ({c})")
+    conn.commit()
+
+class _JsonStream:
+    # Minimal pull parser: walks objects key by key and decodes one value at a
+    # time, so migrating a big database.json never holds the whole document.
+    def __init__(self, f, chunk_size: int = 1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        # read at least as much as is buffered: a long value is decoded again
+        # from its start after every refill, so the buffer must grow geometrically
+        data = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, ch: str):
+        if self.peek() != ch:
+            raise ValueError(f"JSON: ожидался {ch!r} на позиции {self.pos}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number cut at the chunk border ("1.5" of "1.5e3") also decodes
+                is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                if self.eof or len(self.buf) - end > (32 if is_number else 0):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def keys(self):
+        # yields object keys; the caller must consume each value before next()
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            ch = self.peek()
+            self.pos += 1
+            if ch == "}":
+                return
+            if ch != ",":
+                raise ValueError(f"JSON: неожиданный символ {ch!r}")
+
+def migrate_json_to_sqlite(tables: dict, path: str = DB_PATH, batch: int = 10000) -> int:
+    n = 0
+    with open(path, "r", encoding="utf-8") as f:
+        js = _JsonStream(f)
+        if js.peek() != "{":
+            return 0
+        for key in js.keys():
+            if key in tables and js.peek() == "{":
+                for sub_key in js.keys():
+                    tables[key][sub_key] = js.value()
+                    n += 1
+                    if n % batch == 0:
+                        sql_conn.commit()
+            else:
+                value = js.value()
+                # old format {code: file_info}
+                if isinstance(value, dict) and "file_id" in value:
+                    tables["files"][key] = value
+                    n += 1
+    sql_conn.commit()
+    return n
+
+def _load_sqlite_db():
+    global sql_conn
+    sql_conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+    sql_conn.execute("PRAGMA journal_mode=WAL")
+    sql_conn.execute("PRAGMA synchronous=NORMAL")
+    sql_conn.execute("PRAGMA busy_timeout=5000")
+    _create_sql_schema(sql_conn)
+
+    tables = {name: SqlTable(sql_conn, name) for name in SQL_TABLES}
+
+    migrated = sql_conn.execute("SELECT value FROM meta WHERE key = 'migrated_from_json'").fetchone()
+    if not migrated and os.path.exists(DB_PATH):
+        n = migrate_json_to_sqlite(tables)
+        sql_conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from_json', ?)", (dt_to_iso(now_utc()),)
+        )
+        sql_conn.commit()
+        print(f"DB: migrated {n} records from {DB_PATH} to {SQLITE_PATH}")
+
+    tables["settings"].setdefault("monthly_price_usd", DEFAULT_PRICE_USD)
+    sql_conn.commit()
+    return tables
+
+def _read_json_db(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        if not COMPACT_RECORDS:
+            return json.load(f)
+        # records are packed as they are decoded, so the database never
+        # exists whole as plain dicts
+        js = _JsonStream(f)
+        db = {}
+        for key in js.keys():
+            record_cls = COMPACT_SECTIONS.get(key)
+            if js.peek() != "{":
+                db[key] = js.value()
+            elif record_cls:
+                db[key] = {k: record_cls.from_dict(js.value()) for k in js.keys()}
+            else:
+                db[key] = {k: js.value() for k in js.keys()}
+        return db
 
 def load_db():
+    global _db_start_stamp
+    if STORAGE == "sqlite":
+        return _load_sqlite_db()
+
     if not os.path.exists(DB_PATH):
         db = {}
     else:
         try:
-            with open(DB_PATH, "r", encoding="utf-8") as f:
-                db = json.load(f)
-        except Exception:
+            db = _read_json_db(DB_PATH)
+        except Exception as e:
+            # start empty, but keep the unreadable file: it is overwritten below
+            broken = f"{DB_PATH}.broken-{int(time.time())}"
+            os.replace(DB_PATH, broken)
+            _db_start_stamp = None
+            print(f"❌ {DB_PATH} не читается ({e}), сохранён как {broken}")
             db = {}
 
     # Migration: old format {code: file_info}
@@ -102,29 +1158,47 @@ def load_db():
     db.setdefault("users", {})
     db.setdefault("invoices", {})
     db.setdefault("settings", {})
+    db.setdefault("stats", {})
+    db.setdefault("backups", {})
+    db.setdefault("backups_failed", {})
     db["settings"].setdefault("monthly_price_usd", DEFAULT_PRICE_USD)
+    for name in SQL_TABLES:
+        db[name] = json_section(name, db[name])
 
-    save_db(db)
+    _write_db_file(_dump_db(db))
     return db
 
+_db_start_stamp = _db_file_stamp()  # database.json as the last run left it, see _resume_changes
 db = load_db()
 
 # =======================
 # USERS / SUBS
 # =======================
+LAST_SEEN_RESOLUTION = timedelta(minutes=10)  # a fresher last_seen alone isn't worth a write
+
 def ensure_user(u: types.User):
     uid = str(u.id)
-    user = db["users"].get(uid, {})
-    user["id"] = u.id
-    user["username"] = u.username or ""
-    user["tag"] = ("@" + u.username) if u.username else "—"
-    user["first_name"] = u.first_name or ""
-    user["last_name"] = u.last_name or ""
-    user["last_seen"] = dt_to_iso(now_utc())
-    user.setdefault("sub_until", None)      # ISO
-    user.setdefault("last_invoice", None)   # invoice_id
-    db["users"][uid] = user
-    save_db(db)
+    fields = {
+        "id": u.id,
+        "username": u.username or "",
+        "tag": ("@" + u.username) if u.username else "—",
+        "first_name": u.first_name or "",
+        "last_name": u.last_name or "",
+    }
+    user = db["users"].get(uid)
+    if user and "sub_until" in user and "last_invoice" in user and all(user.get(k) == v for k, v in fields.items()):
+        seen = iso_to_dt(user.get("last_seen"))
+        if seen and now_utc() - seen < LAST_SEEN_RESOLUTION:
+            return user
+    with db_tx():
+        user = db["users"].get(uid, {})
+        user.update(fields)
+        user["last_seen"] = dt_to_iso(now_utc())
+        user.setdefault("sub_until", None)      # ISO
+        user.setdefault("last_invoice", None)   # invoice_id
+        db["users"][uid] = user
+        index_user(u.id, user["username"])
+        save_db(db)
     return user
 
 def is_admin(user_id: int) -> bool:
@@ -145,13 +1219,16 @@ def has_active_sub(user: dict) -> bool:
 
 def extend_sub(user_id: int, days: int = 30):
     uid = str(user_id)
-    user = db["users"].get(uid) or {"id": user_id}
-    cur = sub_until_dt(user)
-    base = cur if (cur and cur > now_utc()) else now_utc()
-    new_until = base + timedelta(days=days)
-    user["sub_until"] = dt_to_iso(new_until)
-    db["users"][uid] = user
-    save_db(db)
+    with db_tx():
+        user = db["users"].get(uid) or {"id": user_id}
+        cur = sub_until_dt(user)
+        base = cur if (cur and cur > now_utc()) else now_utc()
+        new_until = base + timedelta(days=days)
+        user["sub_until"] = dt_to_iso(new_until)
+        db["users"][uid] = user
+        index_user(user_id, user.get("username"))
+        index_sub(user_id, new_until)
+        save_db(db)
     return new_until
 
 def fmt_sub(user: dict) -> str:
@@ -169,19 +1246,618 @@ def gen_code(n=16):
     alphabet = string.ascii_letters + string.digits
     return "".join(random.choice(alphabet) for _ in range(n))
 
+_bot_username = None  # set at startup, so file_link() doesn't call getMe
+
+def bot_username() -> str:
+    global _bot_username
+    if _bot_username is None:
+        _bot_username = bot.get_me().username
+    return _bot_username
+
+def file_link(code: str) -> str:
+    return f"https://t.me/{bot_username()}?start={code}"
+
+def get_file(code: str):
+    # alias records (dedup) carry their own name/uploader/date and borrow
+    # file_id and backup fields from the record they point to
+    f = db["files"].get(code)
+    if f and f.get("alias_of"):
+        base = db["files"].get(f["alias_of"])
+        if not base:
+            return None
+        f = {**base, **f}
+    return f
+
+def put_file(code: str, rec: dict):
+    put_files([(code, rec)])
+
+def put_files(items: list[tuple[str, dict]], backups: list[tuple[str, dict]] = ()):
+    # backups: jobs for the backup queue, written in the same transaction
+    with db_tx(immediate=False):
+        for code, rec in items:
+            is_new = code not in db["files"]
+            db["files"][code] = rec
+            invalidate_file(code)
+            if is_new:
+                index_file(code, rec)
+        for code, job in backups:
+            put_backup_job(code, job)
+        save_db(db)
+    if backups:
+        _backup_wakeup.set()
+
+# Hot records for /start downloads: code -> (expires, record, caption), LRU
+# bounded by FILE_CACHE_SIZE. Every write of a file record must call
+# invalidate_file(); entries also expire after FILE_CACHE_TTL, so writes made
+# by other worker processes show up.
+_file_cache: OrderedDict = OrderedDict()
+_file_cache_aliases: dict = {}  # alias_of -> cached codes of its aliases
+_file_cache_lock = threading.Lock()
+_file_cache_gen = 0
+
+def _uncache(code: str, hit=None):
+    # under _file_cache_lock; hit: the entry, if already popped
+    hit = hit or _file_cache.pop(code, None)
+    base = hit and hit[1].get("alias_of")
+    if base:
+        aliases = _file_cache_aliases.get(base)
+        aliases.discard(code)
+        if not aliases:
+            del _file_cache_aliases[base]
+
+def clear_file_cache():
+    global _file_cache_gen
+    with _file_cache_lock:
+        _file_cache_gen += 1
+        _file_cache.clear()
+        _file_cache_aliases.clear()
+
+def invalidate_file(code: str):
+    global _file_cache_gen
+    with _file_cache_lock:
+        _file_cache_gen += 1
+        _uncache(code)
+        for c in _file_cache_aliases.pop(code, ()):
+            _file_cache.pop(c, None)
+
+def download_caption(f: dict) -> str:
+    return (
+        "ℹ️ <b>Файл</b>\n"
+        f"Имя: <code>{html.escape(f.get('file_name') or '')}</code>\n"
+        f"Тип: <code>{html.escape(f.get('mime_type') or '')}</code>\n"
+        f"Отправитель: <code>{html.escape(f.get('u_tag') or '—')}</code>\n"
+        f"Дата: <code>{f.get('created_at', '')}</code>"
+    )
+
+def cached_file(code: str):
+    # -> (record, caption) or None
+    now = time.monotonic()
+    with _file_cache_lock:
+        hit = _file_cache.get(code)
+        if hit and hit[0] > now:
+            _file_cache.move_to_end(code)
+            metrics.inc("file_cache_total", (("result", "hit"),))
+            return hit[1], hit[2]
+        gen = _file_cache_gen
+    metrics.inc("file_cache_total", (("result", "miss"),))
+    f = get_file(code)
+    if not f:
+        return None
+    caption = download_caption(f)
+    with _file_cache_lock:
+        if gen == _file_cache_gen and FILE_CACHE_SIZE:  # no write raced the read
+            _uncache(code)
+            _file_cache[code] = (now + FILE_CACHE_TTL, f, caption)
+            if f.get("alias_of"):
+                _file_cache_aliases.setdefault(f["alias_of"], set()).add(code)
+            while len(_file_cache) > FILE_CACHE_SIZE:
+                _uncache(*_file_cache.popitem(last=False))
+    return f, caption
+
+# =======================
+# INDEXES
+# =======================
+# JSON storage keeps derived structures next to `db`, rebuilt at load and
+# updated on every write: u_id -> codes (upload order), (sub_until timestamp,
+# uid) pairs and user ids / lowercased usernames, all sorted for bisect, and a
+# heap of (due, code) for the backup queue (stale entries are skipped when
+# popped). SQLite answers the same questions from its column indexes.
+files_by_user: dict[int, list[str]] = {}
+files_by_unique: dict[str, str] = {}  # file_unique_id -> code of the backing record
+sub_expiry: list[tuple[float, int]] = []
+_sub_expiry_of: dict[int, float] = {}
+users_by_id: list[int] = []
+users_by_name: list[tuple[str, int]] = []
+_user_name_of: dict[int, str] = {}
+backups_due: list[tuple[float, str]] = []
+
+def index_file(code: str, rec: dict):
+    index_search(code, rec)
+    if STORAGE == "sqlite":
+        return
+    if rec.get("u_id") is not None:
+        files_by_user.setdefault(int(rec["u_id"]), []).append(code)
+    index_unique(code, rec)
+
+def index_unique(code: str, rec: dict):
+    fuid = rec.get("file_unique_id")
+    if STORAGE != "sqlite" and fuid and not rec.get("alias_of"):
+        files_by_unique.setdefault(fuid, code)
+
+def unindex_file(code: str, rec: dict):
+    if STORAGE == "sqlite":
+        return
+    with db_lock:
+        uid = rec.get("u_id")
+        codes = files_by_user.get(int(uid)) if uid is not None else None
+        if codes and code in codes:
+            codes.remove(code)
+            if not codes:
+                del files_by_user[int(uid)]
+        fuid = rec.get("file_unique_id")
+        if fuid and files_by_unique.get(fuid) == code:
+            del files_by_unique[fuid]
+
+def find_by_unique(file_unique_id: str | None):
+    if not file_unique_id:
+        return None
+    if STORAGE == "sqlite":
+        for code, _ in db["files"].rows("file_unique_id = ?", (file_unique_id,), order="rowid", limit=1):
+            return code
+        return None
+    return files_by_unique.get(file_unique_id)
+
+def index_sub(user_id: int, until: datetime | None):
+    if STORAGE == "sqlite":
+        return
+    uid = int(user_id)
+    with db_lock:
+        old = _sub_expiry_of.pop(uid, None)
+        if old is not None:
+            i = bisect.bisect_left(sub_expiry, (old, uid))
+            if i < len(sub_expiry) and sub_expiry[i] == (old, uid):
+                del sub_expiry[i]
+        if until is not None:
+            ts = until.timestamp()
+            bisect.insort(sub_expiry, (ts, uid))
+            _sub_expiry_of[uid] = ts
+
+def index_user(user_id: int, username: str | None):
+    if STORAGE == "sqlite":
+        return
+    uid = int(user_id)
+    name = (username or "").lower()
+    with db_lock:
+        if uid not in _user_name_of:
+            bisect.insort(users_by_id, uid)
+        else:
+            old = _user_name_of[uid]
+            if old == name:
+                return
+            if old:
+                i = bisect.bisect_left(users_by_name, (old, uid))
+                if i < len(users_by_name) and users_by_name[i] == (old, uid):
+                    del users_by_name[i]
+        _user_name_of[uid] = name
+        if name:
+            bisect.insort(users_by_name, (name, uid))
+
+def rebuild_indexes():
+    if STORAGE == "sqlite":
+        rebuild_search_sql(force=False)
+        return
+    with db_lock:
+        files_by_user.clear()
+        files_by_unique.clear()
+        _search_codes.clear()
+        _search_postings.clear()
+        for code, rec in db["files"].items():
+            index_file(code, rec)
+        pairs = []
+        _user_name_of.clear()
+        for uid, u in db["users"].items():
+            until = iso_to_dt(u.get("sub_until"))
+            if until:
+                pairs.append((until.timestamp(), int(uid)))
+            _user_name_of[int(uid)] = (u.get("username") or "").lower()
+        pairs.sort()
+        sub_expiry[:] = pairs
+        _sub_expiry_of.clear()
+        _sub_expiry_of.update((uid, ts) for ts, uid in pairs)
+
+        users_by_id[:] = sorted(_user_name_of)
+        users_by_name[:] = sorted((name, uid) for uid, name in _user_name_of.items() if name)
+
+        backups_due[:] = [(job["due"], code) for code, job in db["backups"].items()]
+        heapq.heapify(backups_due)
+
+def count_subs_until(start: datetime, end: datetime | None = None) -> int:
+    # subscriptions with start < sub_until <= end (end=None: no upper bound)
+    if STORAGE == "sqlite":
+        if end is None:
+            return db["users"].count("sub_until > ?", (dt_to_iso(start),))
+        return db["users"].count("sub_until > ? AND sub_until <= ?", (dt_to_iso(start), dt_to_iso(end)))
+    with db_lock:
+        lo = bisect.bisect_right(sub_expiry, (start.timestamp(), float("inf")))
+        hi = len(sub_expiry) if end is None else bisect.bisect_right(sub_expiry, (end.timestamp(), float("inf")))
+        return max(0, hi - lo)
+
+def count_active_subs() -> int:
+    return count_subs_until(now_utc())
+
+def count_expiring_subs(days: int) -> int:
+    now = now_utc()
+    return count_subs_until(now, now + timedelta(days=days))
+
+def user_file_count(user_id: int) -> int:
+    if STORAGE == "sqlite":
+        return db["files"].count("u_id = ?", (int(user_id),))
+    return len(files_by_user.get(int(user_id), ()))
+
+def user_files(user_id: int, offset: int = 0, limit: int = 10) -> list[tuple[str, dict]]:
+    # newest first
+    if STORAGE == "sqlite":
+        return list(db["files"].find("u_id = ?", (int(user_id),), order="rowid DESC", limit=limit, offset=offset))
+    with db_lock:
+        codes = files_by_user.get(int(user_id), [])
+        end = len(codes) - offset
+        picked = codes[max(0, end - limit):max(0, end)][::-1]
+        return [(c, db["files"][c]) for c in picked if c in db["files"]]
+
+def users_page(flt: str, offset: int, limit: int) -> tuple[int, list[dict]]:
+    # flt: "a" all by id, "on" active (expiring first), "off" expired (latest
+    # first), "p:<prefix>" username prefix. Returns (total, users on page).
+    now = now_utc()
+    if STORAGE == "sqlite":
+        if flt == "on":
+            where, params, order = "sub_until > ?", (dt_to_iso(now),), "sub_until"
+        elif flt == "off":
+            where, params, order = "sub_until <= ?", (dt_to_iso(now),), "sub_until DESC"
+        elif flt.startswith("p:"):
+            where, params, order = "username >= ? AND username < ?", (flt[2:], flt[2:] + "\uffff"), "username"
+        else:
+            where, params, order = "", (), "uid"
+        total = db["users"].count(where, params)
+        return total, [u for _, u in db["users"].find(where, params, order, limit, offset)]
+
+    with db_lock:
+        if flt in ("on", "off"):
+            lo = bisect.bisect_right(sub_expiry, (now.timestamp(), float("inf")))
+            if flt == "on":
+                total = len(sub_expiry) - lo
+                ids = [uid for _, uid in sub_expiry[lo + offset:lo + offset + limit]]
+            else:
+                total = lo
+                ids = [uid for _, uid in sub_expiry[max(0, lo - offset - limit):max(0, lo - offset)][::-1]]
+        elif flt.startswith("p:"):
+            prefix = flt[2:].lower()
+            i = bisect.bisect_left(users_by_name, (prefix,))
+            j = bisect.bisect_left(users_by_name, (prefix + "\uffff",))
+            total = j - i
+            ids = [uid for _, uid in users_by_name[i + offset:min(j, i + offset + limit)]]
+        else:
+            total = len(users_by_id)
+            ids = users_by_id[offset:offset + limit]
+        return total, [db["users"].get(str(uid)) or {"id": uid} for uid in ids]
+
+# =======================
+# SEARCH (inline mode)
+# =======================
+# Files are found by name and MIME type, lowercased with punctuation turned
+# into spaces. A query word of 3+ chars matches anywhere, a shorter one only
+# at a word start. JSON storage keeps an inverted index in memory: every
+# trigram and 1-2 char word prefix -> doc ids in upload order; a query walks
+# the rarest posting list newest first and probes the others with bisect.
+# SQLite uses an FTS5 trigram table (files_fts) when the library has one.
+# A user with fewer files than that is simply scanned. Removed files stay in
+# the index until restart (JSON) or the end of the sweep (SQLite) and are
+# skipped because their record is gone.
+SEARCH_SCAN_MAX = 20000  # SQLite: users with up to this many files are scanned
+
+_search_codes: list[str] = []           # doc id -> code
+_search_postings: dict[str, array] = {}  # gram -> ascending doc ids
+_search_gen = 0                          # bumped by every indexed file
+_search_fts = False
+
+def search_text(name, mime) -> str:
+    return " ".join(re.findall(r"[^\W_]+", f"{name or ''} {mime or ''}".lower()))
+
+def search_tokens(query: str) -> list[str]:
+    return list(dict.fromkeys(re.findall(r"[^\W_]+", (query or "").lower())))
+
+def _grams(text: str) -> set:
+    grams = {text[i:i + 3] for i in range(len(text) - 2)}
+    for w in text.split():
+        grams.add("\0" + w[:1])
+        grams.add("\0" + w[:2])
+    return grams
+
+def _token_grams(token: str) -> list[str]:
+    if len(token) < 3:
+        return ["\0" + token]
+    return [token[i:i + 3] for i in range(len(token) - 2)]
+
+def _text_matches(rec: dict, tokens: list[str]) -> bool:
+    text = " " + search_text(rec.get("file_name"), rec.get("mime_type"))
+    return all((t in text) if len(t) >= 3 else (" " + t) in text for t in tokens)
+
+def _has_doc(arr: array, doc: int) -> bool:
+    i = bisect.bisect_left(arr, doc)
+    return i < len(arr) and arr[i] == doc
+
+def index_search(code: str, rec: dict):
+    global _search_gen
+    _search_gen += 1
+    text = search_text(rec.get("file_name"), rec.get("mime_type"))
+    if STORAGE == "sqlite":
+        if _search_fts:
+            sql_conn.execute("INSERT INTO files_fts (code, text) VALUES (?, ?)", (code, text))
+        return
+    doc = len(_search_codes)
+    _search_codes.append(code)
+    for g in _grams(text):
+        arr = _search_postings.get(g)
+        if arr is None:
+            arr = _search_postings[g] = array("I")
+        arr.append(doc)
+
+def rebuild_search_sql(force: bool):
+    # builds files_fts once (or again after a restore, force=True)
+    global _search_fts
+    sql_conn.create_function("search_text", 2, search_text, deterministic=True)
+    try:
+        with db_tx():
+            sql_conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(code UNINDEXED, text, tokenize='trigram')"
+            )
+            built = sql_conn.execute("SELECT 1 FROM meta WHERE key = 'search_index'").fetchone()
+            if force or not built:
+                sql_conn.execute("DELETE FROM files_fts")
+                sql_conn.execute(
+                    "INSERT INTO files_fts (code, text) SELECT code, "
+                    "search_text(json_extract(data, '$.file_name'), json_extract(data, '$.mime_type')) "
+                    "FROM files ORDER BY rowid"
+                )
+                sql_conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('search_index', ?)", (dt_to_iso(now_utc()),)
+                )
+                save_db(db)
+    except sqlite3.OperationalError as e:
+        print(f"Search: no FTS5 trigram tokenizer ({e}), falling back to scans")
+        return
+    _search_fts = True
+
+def purge_search_index():
+    # SQLite: drop rows of files removed by the sweeper
+    if STORAGE == "sqlite" and _search_fts:
+        with db_tx():
+            sql_conn.execute("DELETE FROM files_fts WHERE code NOT IN (SELECT code FROM files)")
+            save_db(db)
+
+def _scan_matches(rows, tokens: list[str], want: int) -> list[tuple[str, dict]]:
+    found = []
+    for code, rec in rows:
+        if rec is not None and _text_matches(rec, tokens):
+            found.append((code, rec))
+            if len(found) >= want:
+                break
+    return found
+
+def _search_sql(tokens: list[str], owner: int | None, offset: int, limit: int) -> list[tuple[str, dict]]:
+    if owner is not None and (not _search_fts or user_file_count(owner) <= SEARCH_SCAN_MAX):
+        return _scan_matches(db["files"].find("u_id = ?", (owner,), order="rowid DESC"), tokens, offset + limit)[offset:]
+    if not _search_fts:
+        return _scan_matches(db["files"].find("", (), order="rowid DESC"), tokens, offset + limit)[offset:]
+    where, params = [], []
+    long_tokens = [t for t in tokens if len(t) >= 3]
+    if long_tokens:
+        where.append("files_fts MATCH ?")
+        params.append(" ".join(f'"{t}"' for t in long_tokens))
+    for t in tokens:
+        if len(t) < 3:
+            where.append("(' ' || s.text) LIKE ?")
+            params.append(f"% {t}%")
+    if owner is not None:
+        where.append("f.u_id = ?")
+        params.append(owner)
+    with db_lock:
+        rows = sql_conn.execute(
+            "SELECT f.code, f.data FROM files_fts s JOIN files f ON f.code = s.code "
+            f"WHERE {' AND '.join(where)} ORDER BY s.rowid DESC LIMIT ? OFFSET ?",
+            (*params, limit, offset),
+        ).fetchall()
+    return [(code, json.loads(data)) for code, data in rows]
+
+def search_files(query: str, owner: int | None, offset: int, limit: int) -> list[tuple[str, dict]]:
+    # newest first; owner=None searches everyone's files. An empty query
+    # lists the owner's files.
+    tokens = search_tokens(query)
+    if not tokens:
+        return user_files(owner, offset, limit) if owner is not None else []
+    if STORAGE == "sqlite":
+        return _search_sql(tokens, owner, offset, limit)
+
+    want = offset + limit
+    with db_lock:
+        lists = []
+        for t in tokens:
+            for g in _token_grams(t):
+                arr = _search_postings.get(g)
+                if arr is None:
+                    return []
+                lists.append(arr)
+        lists.sort(key=len)
+        own = files_by_user.get(owner, []) if owner is not None else None
+        own = own[:] if own is not None and len(own) <= len(lists[0]) else None
+    if own is not None:
+        return _scan_matches(((c, db["files"].get(c)) for c in reversed(own)), tokens, want)[offset:]
+
+    rarest, others = lists[0], lists[1:]
+    found = []
+    for i in range(len(rarest) - 1, -1, -1):
+        doc = rarest[i]
+        if not all(_has_doc(arr, doc) for arr in others):
+            continue
+        code = _search_codes[doc]
+        rec = db["files"].get(code)
+        if rec is None or (owner is not None and rec.get("u_id") != owner) or not _text_matches(rec, tokens):
+            continue
+        found.append((code, rec))
+        if len(found) >= want:
+            break
+    return found[offset:]
+
+# Answers by (owner, owner's file count or _search_gen for everyone's files,
+# query, offset): a new upload changes the key, so only SEARCH_CACHE_TTL
+# bounds how stale a result can be after a file is removed.
+_search_cache: OrderedDict = OrderedDict()
+_search_cache_lock = threading.Lock()
+
+def cached_search(query: str, owner: int | None, offset: int, limit: int) -> list[tuple[str, dict]]:
+    # -> [(code, record with alias resolved)]
+    marker = user_file_count(owner) if owner is not None else _search_gen
+    key = (owner, marker, " ".join(search_tokens(query)), offset, limit)
+    now = time.monotonic()
+    with _search_cache_lock:
+        hit = _search_cache.get(key)
+        if hit and hit[0] > now:
+            _search_cache.move_to_end(key)
+            metrics.inc("search_cache_total", (("result", "hit"),))
+            return hit[1]
+    metrics.inc("search_cache_total", (("result", "miss"),))
+    t0 = time.perf_counter()
+    found = []
+    for code, rec in search_files(query, owner, offset, limit):
+        f = get_file(code) if rec.get("alias_of") else rec
+        if f and f.get("file_id"):
+            found.append((code, f))
+    metrics.observe("search_seconds", time.perf_counter() - t0)
+    with _search_cache_lock:
+        if SEARCH_CACHE_SIZE:
+            _search_cache[key] = (now + SEARCH_CACHE_TTL, found)
+            _search_cache.move_to_end(key)
+            while len(_search_cache) > SEARCH_CACHE_SIZE:
+                _search_cache.popitem(last=False)
+    return found
+
+rebuild_indexes()
+
 # =======================
 # CRYPTO PAY (CryptoBot)
 # =======================
+# One keep-alive session for all calls. Transport errors and 5xx are retried
+# with jittered backoff (createInvoice only when the request never left, so
+# no duplicate invoices); after CRYPTOPAY_BREAKER_THRESHOLD failed calls in a
+# row the breaker fails fast for CRYPTOPAY_BREAKER_COOLDOWN seconds.
+IDEMPOTENT_CRYPTO_METHODS = {"getMe", "getInvoices", "getBalance", "getExchangeRates", "getCurrencies"}
+
+class CryptoPayUnavailable(RuntimeError):
+    pass
+
+crypto_session = requests.Session()
+crypto_session.headers["Crypto-Pay-API-Token"] = CRYPTOPAY_TOKEN
+crypto_session.mount("https://", HTTPAdapter(pool_maxsize=CRYPTOPAY_POOL_SIZE, max_retries=0))
+crypto_session.mount("http://", HTTPAdapter(pool_maxsize=CRYPTOPAY_POOL_SIZE, max_retries=0))
+
+_crypto_lock = threading.Lock()
+_crypto_breaker = {"failures": 0, "open_until": 0.0}
+
+def _crypto_record(method: str, ms: float, error: bool = False, retry: bool = False):
+    labels = (("method", method),)
+    metrics.observe("cryptopay_api_seconds", ms / 1000, labels)
+    if error:
+        metrics.inc("cryptopay_api_errors_total", labels)
+    if retry:
+        metrics.inc("cryptopay_api_retries_total", labels)
+
+def _crypto_breaker_result(ok: bool):
+    with _crypto_lock:
+        if ok:
+            _crypto_breaker["failures"] = 0
+            return
+        _crypto_breaker["failures"] += 1
+        if _crypto_breaker["failures"] >= CRYPTOPAY_BREAKER_THRESHOLD:
+            _crypto_breaker["open_until"] = time.monotonic() + CRYPTOPAY_BREAKER_COOLDOWN
+
 def crypto_request(method: str, payload: dict):
+    if time.monotonic() < _crypto_breaker["open_until"]:
+        _crypto_record(method, 0.0, error=True)
+        raise CryptoPayUnavailable("Crypto Pay временно недоступен, попробуй позже")
+
     url = CRYPTOPAY_BASE + method
-    headers = {"Crypto-Pay-API-Token": CRYPTOPAY_TOKEN}
-    r = requests.post(url, headers=headers, json=payload, timeout=20)
-    data = r.json()
-    if not data.get("ok"):
-        raise RuntimeError(str(data))
-    return data["result"]
-
-def create_invoice_for_month(user_id: int):
+    idempotent = method in IDEMPOTENT_CRYPTO_METHODS
+    for attempt in range(CRYPTOPAY_RETRIES + 1):
+        last = attempt == CRYPTOPAY_RETRIES
+        t0 = time.monotonic()
+        try:
+            r = crypto_session.post(url, json=payload, timeout=CRYPTOPAY_TIMEOUT)
+            if r.status_code >= 500:
+                raise CryptoPayUnavailable(f"Crypto Pay HTTP {r.status_code}")
+        except (requests.exceptions.RequestException, CryptoPayUnavailable) as e:
+            ms = (time.monotonic() - t0) * 1000
+            retryable = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+            if last or not retryable:
+                _crypto_record(method, ms, error=True)
+                _crypto_breaker_result(False)
+                raise
+            _crypto_record(method, ms, error=True, retry=True)
+            time.sleep(random.uniform(0, min(2.0, 0.25 * 2 ** attempt)))
+            continue
+
+        _crypto_record(method, (time.monotonic() - t0) * 1000)
+        _crypto_breaker_result(True)
+        data = r.json()
+        if not data.get("ok"):
+            raise RuntimeError(str(data))
+        return data["result"]
+
+_acrypto_session = None  # aiohttp.ClientSession, ENGINE=async
+
+async def acrypto_request(method: str, payload: dict):
+    # crypto_request() for handlers: same retries, breaker and metrics, but on
+    # the asyncio engine it waits on the loop instead of holding a thread
+    if _acrypto_session is None:
+        return crypto_request(method, payload)
+    if time.monotonic() < _crypto_breaker["open_until"]:
+        _crypto_record(method, 0.0, error=True)
+        raise CryptoPayUnavailable("Crypto Pay временно недоступен, попробуй позже")
+
+    url = CRYPTOPAY_BASE + method
+    idempotent = method in IDEMPOTENT_CRYPTO_METHODS
+    for attempt in range(CRYPTOPAY_RETRIES + 1):
+        last = attempt == CRYPTOPAY_RETRIES
+        t0 = time.monotonic()
+        try:
+            async with _acrypto_session.post(url, json=payload) as r:
+                if r.status >= 500:
+                    raise CryptoPayUnavailable(f"Crypto Pay HTTP {r.status}")
+                data = await r.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, CryptoPayUnavailable) as e:
+            ms = (time.monotonic() - t0) * 1000
+            retryable = idempotent or isinstance(e, aiohttp.ClientConnectorError)  # never sent
+            if last or not retryable:
+                _crypto_record(method, ms, error=True)
+                _crypto_breaker_result(False)
+                raise
+            _crypto_record(method, ms, error=True, retry=True)
+            await asyncio.sleep(random.uniform(0, min(2.0, 0.25 * 2 ** attempt)))
+            continue
+
+        _crypto_record(method, (time.monotonic() - t0) * 1000)
+        _crypto_breaker_result(True)
+        if not data.get("ok"):
+            raise RuntimeError(str(data))
+        return data["result"]
+
+def open_acrypto_session():
+    global _acrypto_session
+    _acrypto_session = aiohttp.ClientSession(
+        headers={"Crypto-Pay-API-Token": CRYPTOPAY_TOKEN},
+        timeout=aiohttp.ClientTimeout(sock_connect=CRYPTOPAY_TIMEOUT[0], sock_read=CRYPTOPAY_TIMEOUT[1]),
+        connector=aiohttp.TCPConnector(limit=CRYPTOPAY_POOL_SIZE),
+    )
+
+async def create_invoice_for_month(user_id: int):
     price = get_price()
     payload = {
         "amount": f"{price:.2f}",
@@ -192,26 +1868,993 @@ def create_invoice_for_month(user_id: int):
         "allow_anonymous": False,
         "allow_comments": False,
     }
-    inv = crypto_request("createInvoice", payload)
+    inv = await acrypto_request("createInvoice", payload)
     invoice_id = str(inv.get("invoice_id"))
     pay_url = inv.get("pay_url") or inv.get("bot_invoice_url") or ""
-    db["invoices"][invoice_id] = {
-        "invoice_id": invoice_id,
-        "user_id": user_id,
-        "created_at": dt_to_iso(now_utc()),
-        "status": inv.get("status", "active"),
-        "amount_usd": price,
-        "pay_url": pay_url,
-    }
-    save_db(db)
+    with db_tx(immediate=False):
+        db["invoices"][invoice_id] = {
+            "invoice_id": invoice_id,
+            "user_id": user_id,
+            "created_at": dt_to_iso(now_utc()),
+            "status": inv.get("status", "active"),
+            "amount_usd": price,
+            "pay_url": pay_url,
+            "expires_in": payload["expires_in"],
+        }
+        save_db(db)
     return invoice_id, pay_url
 
-def get_invoice_status(invoice_id: str):
-    res = crypto_request("getInvoices", {"invoice_ids": invoice_id})
-    items = res.get("items", [])
-    if not items:
+def get_invoices(invoice_ids: list[str]) -> list[dict]:
+    res = crypto_request("getInvoices", {"invoice_ids": ",".join(invoice_ids), "count": len(invoice_ids)})
+    return res.get("items", [])
+
+# =======================
+# PAYMENTS (background reconciler)
+# =======================
+# Open invoices are polled in batches by one thread; a paid invoice credits the
+# subscription exactly once (credited_at marker) and the user is notified.
+# The chk: button only reads local state and nudges the reconciler.
+FINAL_INVOICE_STATUSES = ("paid", "expired")
+_reconcile_wakeup = threading.Event()
+
+def open_invoice_ids() -> list[str]:
+    if STORAGE == "sqlite":
+        marks = ", ".join("?" * len(FINAL_INVOICE_STATUSES))
+        return [k for k, _ in db["invoices"].rows(f"status IS NULL OR status NOT IN ({marks})", FINAL_INVOICE_STATUSES)]
+    with db_lock:
+        return [k for k, v in db["invoices"].items() if v.get("status") not in FINAL_INVOICE_STATUSES]
+
+def apply_invoice_update(remote: dict):
+    invoice_id = str(remote.get("invoice_id"))
+    status = remote.get("status", "unknown")
+    credited = False
+    with db_tx():
+        rec = db["invoices"].get(invoice_id)
+        if rec is None:
+            return None, False
+        was_paid = rec.get("status") == "paid"
+        rec["status"] = status
+        rec["checked_at"] = dt_to_iso(now_utc())
+        if status == "paid" and not was_paid and not rec.get("credited_at") and rec.get("user_id") is not None:
+            extend_sub(int(rec["user_id"]), days=30)
+            rec["paid_at"] = remote.get("paid_at") or dt_to_iso(now_utc())
+            rec["credited_at"] = dt_to_iso(now_utc())
+            credited = True
+        db["invoices"][invoice_id] = rec
+        save_db(db)
+    return rec, credited
+
+def notify_paid(user_id: int):
+    u = db["users"].get(str(user_id)) or {"id": user_id}
+    try:
+        send_message(user_id, f"✅ Оплата получена, подписка активирована.\n{fmt_sub(u)}", priority=PRIO_BULK, wait=False)
+    except Exception as e:
+        print(f"notify_paid({user_id}) failed: {e}")
+
+def expire_missing_invoices(invoice_ids: list[str]):
+    # invoices Crypto Pay didn't return (deleted, unknown): expired once their time is up
+    now = now_utc()
+    with db_tx():
+        for invoice_id in invoice_ids:
+            rec = db["invoices"].get(invoice_id)
+            if rec is None or rec.get("status") in FINAL_INVOICE_STATUSES:
+                continue
+            created = iso_to_dt(rec.get("created_at"))
+            if created and created + timedelta(seconds=int(rec.get("expires_in") or 900)) > now:
+                continue
+            rec["status"] = "expired"
+            rec["checked_at"] = dt_to_iso(now)
+            db["invoices"][invoice_id] = rec
+        save_db(db)
+
+def reconcile_invoices() -> int:
+    ids = open_invoice_ids()
+    credited = 0
+    for i in range(0, len(ids), RECONCILE_BATCH):
+        batch = ids[i:i + RECONCILE_BATCH]
+        try:
+            items = get_invoices(batch)
+            for item in items:
+                rec, ok = apply_invoice_update(item)
+                if ok:
+                    credited += 1
+                    notify_paid(int(rec["user_id"]))
+            seen = {str(item.get("invoice_id")) for item in items}
+            expire_missing_invoices([k for k in batch if k not in seen])
+        except Exception as e:
+            # one bad batch mustn't stop crediting the rest
+            print(f"Invoice reconcile batch failed: {e}")
+    return credited
+
+def _invoice_reconciler():
+    while True:
+        _reconcile_wakeup.wait(RECONCILE_INTERVAL)
+        _reconcile_wakeup.clear()
+        try:
+            reconcile_invoices()
+        except Exception as e:
+            print(f"Invoice reconcile failed: {e}")
+
+def start_invoice_reconciler():
+    threading.Thread(target=_invoice_reconciler, name="invoice-reconciler", daemon=True).start()
+
+# =======================
+# ARCHIVE (retention sweeper)
+# =======================
+# Every SWEEP_INTERVAL seconds finalized invoices (expired ones after
+# INVOICE_EXPIRED_KEEP_HOURS, paid ones INVOICE_PAID_KEEP_DAYS after crediting)
+# and, with FILE_RETENTION_DAYS set, old file records leave `db` for
+# append-only segments ARCHIVE_DIR/<section>/<YYYY-MM-DD>.jsonl.gz, split by
+# the record's creation date. Per-day download counters go the same way after
+# STATS_KEEP_DAYS; the running totals stay. Each sweep appends one gzip member per segment
+# in a single write, before the records are deleted. Admin lookups (/invoice,
+# /info) fall back to scanning the segments, newest first.
+_last_sweep: dict = {}
+
+def _record_day(rec: dict) -> str:
+    day = str(rec.get("created_at") or rec.get("day") or "")[:10]
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+        return day
+    except ValueError:
+        return now_utc().strftime("%Y-%m-%d")
+
+def file_created_dt(f: dict):
+    try:
+        return datetime.strptime(f.get("created_at") or "", "%Y-%m-%d %H:%M UTC").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+def archive_records(section: str, items: list[tuple[str, dict]]) -> int:
+    # returns compressed bytes appended
+    folder = os.path.join(ARCHIVE_DIR, section)
+    os.makedirs(folder, exist_ok=True)
+    stamp = dt_to_iso(now_utc())
+    by_day: dict[str, list[str]] = {}
+    for key, rec in items:
+        by_day.setdefault(_record_day(rec), []).append(
+            json.dumps({"key": str(key), "archived_at": stamp, "data": rec}, ensure_ascii=False) + "\n"
+        )
+    written = 0
+    for day, lines in by_day.items():
+        member = gzip.compress("".join(lines).encode())
+        with open(os.path.join(folder, day + ".jsonl.gz"), "ab") as f:
+            f.write(member)
+            f.flush()
+            os.fsync(f.fileno())
+        written += len(member)
+    return written
+
+def archive_lookup(section: str, key: str):
+    # -> {"key", "archived_at", "data"} or None
+    folder = os.path.join(ARCHIVE_DIR, section)
+    try:
+        names = sorted((n for n in os.listdir(folder) if n.endswith(".jsonl.gz")), reverse=True)
+    except FileNotFoundError:
+        return None
+    prefix = '{"key": ' + json.dumps(str(key), ensure_ascii=False) + ","
+    for name in names:
+        try:
+            with gzip.open(os.path.join(folder, name), "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith(prefix):
+                        return json.loads(line)
+        except (OSError, EOFError, ValueError) as e:
+            print(f"archive {name}: {e}")
+    return None
+
+def _sweep_section(section: str, keys: list[str], eligible, batch: int = 500) -> tuple[int, int, int]:
+    # eligible(key, rec) is checked again under the lock: the record may have changed
+    moved = reclaimed = written = 0
+    for i in range(0, len(keys), batch):
+        with db_tx():
+            items = []
+            for key in keys[i:i + batch]:
+                rec = db[section].get(key)
+                if rec is not None and eligible(key, rec):
+                    items.append((key, rec))
+            if not items:
+                continue
+            written += archive_records(section, items)
+            for key, rec in items:
+                del db[section][key]
+                if section == "files":
+                    unindex_file(key, rec)
+                    invalidate_file(key)
+                reclaimed += len(key) + len(json.dumps(rec, ensure_ascii=False, separators=(",", ":")).encode())
+            moved += len(items)
+            save_db(db)
+    return moved, reclaimed, written
+
+def _invoice_sweepable(now: datetime):
+    expired_cut = now - timedelta(hours=INVOICE_EXPIRED_KEEP_HOURS)
+    paid_cut = now - timedelta(days=INVOICE_PAID_KEEP_DAYS)
+
+    def eligible(key, rec):
+        status = rec.get("status")
+        if status == "paid":
+            stamp, cut = rec.get("credited_at") or rec.get("paid_at") or rec.get("created_at"), paid_cut
+        elif status == "expired":
+            stamp, cut = rec.get("checked_at") or rec.get("created_at"), expired_cut
+        else:
+            return False
+        when = iso_to_dt(stamp)
+        return bool(when and when.tzinfo and when < cut)
+    return eligible
+
+def _file_sweepable(now: datetime):
+    cut = now - timedelta(days=FILE_RETENTION_DAYS)
+    # a backing record stays while a newer alias still points to it
+    if STORAGE == "sqlite":
+        aliases = list(db["files"].find("json_extract(data, '$.alias_of') IS NOT NULL"))
+    else:
+        with db_lock:
+            aliases = [(c, f) for c, f in db["files"].items() if f.get("alias_of")]
+    keep = {f["alias_of"] for _, f in aliases if (file_created_dt(f) or now) >= cut}
+
+    def eligible(key, rec):
+        created = file_created_dt(rec)
+        return bool(created and created < cut and key not in keep)
+    return eligible
+
+def sweep() -> dict:
+    now = now_utc()
+    t0 = time.perf_counter()
+    report = {"invoices": 0, "files": 0, "stats": 0, "reclaimed_bytes": 0, "archive_bytes": 0}
+
+    eligible = _invoice_sweepable(now)
+    if STORAGE == "sqlite":
+        keys = [k for k, _ in db["invoices"].rows("status IN (?, ?)", FINAL_INVOICE_STATUSES)]
+    else:
+        with db_lock:
+            keys = [k for k, v in db["invoices"].items() if v.get("status") in FINAL_INVOICE_STATUSES]
+    sections = [("invoices", keys, eligible)]
+
+    if FILE_RETENTION_DAYS:
+        cut = dt_to_iso(now - timedelta(days=FILE_RETENTION_DAYS))
+        if STORAGE == "sqlite":
+            keys = [k for k, _ in db["files"].rows("json_extract(data, '$.created_at') < ?", (cut[:10],))]
+        else:
+            with db_lock:
+                keys = [c for c, f in db["files"].items() if str(f.get("created_at", "")) < cut[:10]]
+        sections.append(("files", keys, _file_sweepable(now)))
+
+    if STATS_KEEP_DAYS:
+        cut = (now - timedelta(days=STATS_KEEP_DAYS)).strftime("%Y-%m-%d")
+        old = lambda key, rec: rec.get("day") != STATS_TOTAL_DAY and str(rec.get("day")) < cut
+        if STORAGE == "sqlite":
+            keys = [k for k, _ in db["stats"].rows("day != ? AND day < ?", (STATS_TOTAL_DAY, cut))]
+        else:
+            with db_lock:
+                keys = [k for k, r in dict.items(db["stats"]) if old(k, r)]
+        sections.append(("stats", keys, old))
+
+    for section, keys, eligible in sections:
+        moved, reclaimed, written = _sweep_section(section, keys, eligible)
+        report[section] = moved
+        report["reclaimed_bytes"] += reclaimed
+        report["archive_bytes"] += written
+        if moved:
+            metrics.inc("archive_records_total", (("section", section),), moved)
+    if report["files"]:
+        purge_search_index()
+    metrics.inc("archive_reclaimed_bytes_total", value=report["reclaimed_bytes"])
+    report["seconds"] = round(time.perf_counter() - t0, 3)
+    report["at"] = dt_to_iso(now)
+    _last_sweep.clear()
+    _last_sweep.update(report)
+    if report["invoices"] or report["files"] or report["stats"]:
+        print(
+            f"Sweep: archived {report['invoices']} invoices, {report['files']} files, {report['stats']} stats rows, "
+            f"reclaimed {report['reclaimed_bytes']} bytes ({report['archive_bytes']} bytes of archive)"
+        )
+    return report
+
+def _sweeper():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            sweep()
+        except Exception as e:
+            print(f"Sweep failed: {e}")
+
+def start_sweeper():
+    threading.Thread(target=_sweeper, name="sweeper", daemon=True).start()
+
+# =======================
+# STATS (download counters)
+# =======================
+# The /start CODE path only bumps in-memory counters (code, UTC day) ->
+# [views, downloads, u_id]; every STATS_FLUSH_INTERVAL seconds they are added
+# to db["stats"], one row per code and day, and to running totals in the same
+# section: "<code>:*" per file and "u:<u_id>:*" per uploader (day "*"), so
+# /file and the admin top lists read a few rows instead of summing the days.
+# A view is an opened link to an existing file, a download a document
+# Telegram accepted.
+STATS_TOTAL_DAY = "*"
+_stats_pending: dict = {}
+_stats_lock = threading.Lock()
+
+def count_hit(code: str, u_id, download: bool = False):
+    key = (code, now_utc().strftime("%Y-%m-%d"))
+    with _stats_lock:
+        c = _stats_pending.get(key)
+        if c is None:
+            c = _stats_pending[key] = [0, 0, u_id]
+        c[1 if download else 0] += 1
+
+def _stats_total_keys(code, u_id) -> list[tuple[str, dict]]:
+    keys = [(f"{code}:{STATS_TOTAL_DAY}", {"code": code})]
+    if u_id is not None:
+        keys.append((f"u:{u_id}:{STATS_TOTAL_DAY}", {"u_id": int(u_id)}))
+    return keys
+
+def _add_stats(key: str, base: dict, views: int, downloads: int):
+    row = db["stats"].get(key) or {**base, "views": 0, "downloads": 0}
+    row["views"] += views
+    row["downloads"] += downloads
+    db["stats"][key] = row
+
+def flush_stats() -> int:
+    global _stats_pending
+    with _stats_lock:
+        pending, _stats_pending = _stats_pending, {}
+    if not pending:
+        return 0
+    totals: dict = {}
+    for (code, day), (views, downloads, u_id) in pending.items():
+        for key, base in _stats_total_keys(code, u_id):
+            t = totals.setdefault(key, [base, 0, 0])
+            t[1] += views
+            t[2] += downloads
+    with db_tx():
+        for (code, day), (views, downloads, u_id) in pending.items():
+            _add_stats(f"{code}:{day}", {"code": code, "day": day, "u_id": u_id}, views, downloads)
+        for key, (base, views, downloads) in totals.items():
+            _add_stats(key, {**base, "day": STATS_TOTAL_DAY}, views, downloads)
+        save_db(db)
+    return len(pending)
+
+def backfill_stats_totals():
+    # day rows from before the running totals: add them up once
+    if db["settings"].get("stats_totals"):
+        return
+    with db_tx():
+        if STORAGE == "sqlite":
+            rows = db["stats"].select("code, u_id, SUM(views), SUM(downloads)", "day != ?", (STATS_TOTAL_DAY,),
+                                      "GROUP BY code, u_id")
+        else:
+            rows = [(r.get("code"), r.get("u_id"), r.get("views", 0), r.get("downloads", 0))
+                    for r in dict.values(db["stats"]) if r.get("day") != STATS_TOTAL_DAY]
+        totals: dict = {}
+        for code, u_id, views, downloads in rows:
+            for key, base in _stats_total_keys(code, u_id):
+                t = totals.setdefault(key, [base, 0, 0])
+                t[1] += views or 0
+                t[2] += downloads or 0
+        for key, (base, views, downloads) in totals.items():
+            db["stats"][key] = {**base, "day": STATS_TOTAL_DAY, "views": views, "downloads": downloads}
+        db["settings"]["stats_totals"] = 1
+        save_db(db)
+
+backfill_stats_totals()
+
+def _stats_flusher():
+    while True:
+        time.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            flush_stats()
+        except Exception as e:
+            print(f"Stats flush failed: {e}")
+
+def start_stats_flusher():
+    threading.Thread(target=_stats_flusher, name="stats-flusher", daemon=True).start()
+    atexit.register(flush_stats)  # runs before flush_db (registered earlier)
+
+def _stats_top(field: str, limit: int):
+    # -> [(code or u_id, views, downloads)] from the totals, most downloaded first
+    if STORAGE == "sqlite":
+        return db["stats"].select(f"{field}, views, downloads", f"day = ? AND {field} IS NOT NULL", (STATS_TOTAL_DAY,),
+                                  f"ORDER BY downloads DESC, views DESC LIMIT {int(limit)}")
+    with db_lock:
+        rows = [(r[field], r.get("views", 0), r.get("downloads", 0)) for r in dict.values(db["stats"])
+                if r.get("day") == STATS_TOTAL_DAY and r.get(field) is not None]
+    return heapq.nsmallest(limit, rows, key=lambda r: (-r[2], -r[1]))
+
+def top_files(limit: int = 5):
+    return _stats_top("code", limit)
+
+def top_uploaders(limit: int = 5):
+    return _stats_top("u_id", limit)
+
+def _stats_total(key: str, match) -> tuple[int, int]:
+    # the stored total plus this process' counts not flushed yet
+    row = db["stats"].get(key) or {}
+    views, downloads = row.get("views", 0), row.get("downloads", 0)
+    with _stats_lock:
+        for (code, _), (v, d, u_id) in _stats_pending.items():
+            if match(code, u_id):
+                views += v
+                downloads += d
+    return views, downloads
+
+def file_stats(code: str) -> tuple[int, int]:
+    return _stats_total(f"{code}:{STATS_TOTAL_DAY}", lambda c, u: c == code)
+
+def uploader_stats(u_id) -> tuple[int, int]:
+    if u_id is None:
+        return 0, 0
+    return _stats_total(f"u:{u_id}:{STATS_TOTAL_DAY}", lambda c, u: u is not None and int(u) == int(u_id))
+
+# =======================
+# SNAPSHOTS (database backup to CHANNEL_ID)
+# =======================
+# Every SNAPSHOT_INTERVAL seconds the records written since the last run go to
+# the backup channel as a gzip JSON delta {"set": {section: {key: rec}},
+# "del": {section: [keys]}}. A full snapshot (database.json layout, streamed
+# from the tables) starts the chain and is retaken once SNAPSHOT_MAX_DELTAS
+# deltas pile up or they outweigh it. The chain is listed in a pinned
+# manifest message, so /restore needs nothing but the channel.
+# Changed keys come from TrackedDict (JSON, in memory: a clean shutdown keeps
+# them in snapshot.json for the next start, otherwise it begins with a full
+# snapshot) or the `changes` table (SQLite, shared by workers). Both only track
+# with SNAPSHOT_INTERVAL set; without it /snapshot always takes a full one.
+# /restore downloads through getFile: 20 MB per file on the public Bot API,
+# no limit on a local server (TELEGRAM_API_URL). So a snapshot is sent as
+# parts of at most SNAPSHOT_PART_MB (the gzip bytes cut in order) and the
+# manifest lists every snapshot's parts.
+SNAPSHOT_TAG = "#dbsnap"
+MANIFEST_MAX_CHARS = 4000  # a message holds 4096
+_snapshot_lock = threading.Lock()
+
+def _load_snapshot_state() -> dict:
+    try:
+        with open(SNAPSHOT_STATE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_snapshot_state(state: dict):
+    tmp = SNAPSHOT_STATE_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, SNAPSHOT_STATE_PATH)
+
+def _save_pending_changes():
+    # JSON, at exit: the keys not snapshotted yet, valid for this database.json only
+    flush_stats()
+    flush_db()
+    with _flush_lock, db_lock:
+        if _db_pending:
+            return  # written meanwhile: the next start takes a full snapshot
+        stamp, keys = _db_file_stamp(), sorted(_changed)
+    with _snapshot_lock:
+        state = _load_snapshot_state()
+        if state.get("full") and stamp:
+            state["pending"] = {"db": stamp, "keys": keys}
+            _save_snapshot_state(state)
+
+def _resume_changes() -> bool:
+    # -> False when the delta chain can't go on from database.json (crash, other file)
+    state = _load_snapshot_state()
+    pending = state.pop("pending", None)
+    if pending is None:
+        return False
+    _save_snapshot_state(state)  # good for one start: a crash after it needs a full snapshot
+    if pending["db"] != _db_start_stamp:
+        return False
+    _changed.update((section, key) for section, key in pending["keys"])
+    return True
+
+_snapshot_need_full = STORAGE == "json" and not (SNAPSHOT_INTERVAL and _resume_changes())
+
+def _take_changes():
+    # -> (changed (section, key) pairs, token for _settle_changes)
+    global _changed
+    if STORAGE == "sqlite":
+        with db_lock:
+            top = sql_conn.execute("SELECT MAX(seq) FROM changes").fetchone()[0] or 0
+            keys = sql_conn.execute("SELECT DISTINCT section, key FROM changes WHERE seq <= ?", (top,)).fetchall()
+        return set(keys), top
+    with db_lock:
+        keys, _changed = _changed, set()
+    return keys, keys
+
+def _settle_changes(token, uploaded: bool):
+    if STORAGE == "sqlite":
+        if uploaded:
+            with db_tx():
+                sql_conn.execute("DELETE FROM changes WHERE seq <= ?", (token,))
+                save_db(db)
+    elif not uploaded:
+        with db_lock:
+            _changed.update(token)
+
+def _full_snapshot():
+    # -> (gzip bytes, records, token)
+    if STORAGE != "sqlite":
+        with db_lock:
+            _, token = _take_changes()
+            view = _copy_db({name: db[name] for name in SQL_TABLES})
+        data = _dump_db(view)
+        return gzip.compress(data.encode()), sum(len(v) for v in view.values()), token
+
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+        _, token = _take_changes()  # rows changed while streaming stay for the next delta
+        records = 0
+        gz.write(b"{")
+        for i, name in enumerate(SQL_TABLES):
+            gz.write(("," if i else "").encode() + json.dumps(name).encode() + b":{")
+            for j, (key, data) in enumerate(db[name].rows()):
+                gz.write(("," if j else "").encode() + json.dumps(key, ensure_ascii=False).encode() + b":" + data.encode())
+                records += 1
+            gz.write(b"}")
+        gz.write(b"}")
+    return buf.getvalue(), records, token
+
+def _delta_snapshot():
+    # -> (gzip bytes, records, token) or None when nothing changed
+    keys, token = _take_changes()
+    if not keys:
         return None
-    return items[0]
+    delta = {"set": {}, "del": {}}
+    with db_lock:
+        for section, key in sorted(keys):
+            if section not in SQL_TABLES:
+                continue
+            rec = db[section].get(key)
+            if rec is None:
+                delta["del"].setdefault(section, []).append(key)
+            else:
+                delta["set"].setdefault(section, {})[key] = rec
+        body = json.dumps(delta, ensure_ascii=False, separators=(",", ":")).encode()
+    return gzip.compress(body), len(keys), token
+
+def _part_ids(entry: dict) -> list[str]:
+    # snapshot.json from before parts has one "file_id"
+    return entry.get("file_ids") or [entry["file_id"]]
+
+def _manifest_text(state: dict) -> str:
+    return f"{SNAPSHOT_TAG} manifest\n" + json.dumps({
+        "at": state["full"]["at"],
+        "full": _part_ids(state["full"]),
+        "deltas": [_part_ids(d) for d in state["deltas"]],
+    })
+
+def _publish_manifest(state: dict):
+    text = _manifest_text(state)
+    msg_id = state.get("manifest_msg_id")
+    if msg_id:
+        try:
+            bot.edit_message_text(html.escape(text), CHANNEL_ID, msg_id)
+            return
+        except Exception as e:
+            print(f"manifest edit failed, posting a new one: {e}")
+    msg = bot.send_message(CHANNEL_ID, html.escape(text), disable_notification=True)
+    bot.pin_chat_message(CHANNEL_ID, msg.message_id, disable_notification=True)
+    state["manifest_msg_id"] = msg.message_id
+    _save_snapshot_state(state)
+
+def snapshot_now(full: bool = False) -> dict:
+    global _snapshot_need_full
+    with _snapshot_lock:
+        state = _load_snapshot_state()
+        deltas = state.get("deltas", [])
+        full = (full or not SNAPSHOT_INTERVAL or _snapshot_need_full or not state.get("full") or len(deltas) >= SNAPSHOT_MAX_DELTAS
+                or state.get("delta_bytes", 0) >= state["full"]["bytes"]
+                or len(_manifest_text(state)) + 200 > MANIFEST_MAX_CHARS)  # room for one more delta
+        made = _full_snapshot() if full else _delta_snapshot()
+        if made is None:
+            return {"kind": None}
+        data, records, token = made
+        kind = "full" if full else "delta"
+        stamp = dt_to_iso(now_utc())
+        name = f"db-{kind}-{now_utc().strftime('%Y%m%d-%H%M%S')}.json.gz"
+        parts = [data[i:i + SNAPSHOT_PART_BYTES] for i in range(0, len(data), SNAPSHOT_PART_BYTES)] or [b""]
+        file_ids = []
+        try:
+            for n, part in enumerate(parts, 1):
+                doc = io.BytesIO(part)
+                doc.name = name if len(parts) == 1 else f"{name}.{n:03d}"
+                caption = f"{SNAPSHOT_TAG} {kind}, записей: {records}" + (f", часть {n}/{len(parts)}" if len(parts) > 1 else "")
+                msg = bot.send_document(CHANNEL_ID, doc, caption=caption, disable_notification=True)
+                file_ids.append(msg.document.file_id)
+        except Exception:
+            _settle_changes(token, False)
+            raise
+        _settle_changes(token, True)
+
+        entry = {"file_ids": file_ids, "at": stamp, "bytes": len(data), "records": records}
+        if full:
+            state = {"full": entry, "deltas": [], "delta_bytes": 0, "manifest_msg_id": state.get("manifest_msg_id")}
+        else:
+            state["deltas"] = deltas + [entry]
+            state["delta_bytes"] = state.get("delta_bytes", 0) + len(data)
+        _save_snapshot_state(state)  # before the manifest: a failed edit is retried next run
+        _snapshot_need_full = False
+        metrics.inc("snapshot_uploads_total", (("kind", kind),))
+        metrics.inc("snapshot_bytes_total", (("kind", kind),), len(data))
+        _publish_manifest(state)
+        return {"kind": kind, "records": records, "bytes": len(data), "parts": len(parts), "deltas": len(state["deltas"])}
+
+def _snapshotter():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        try:
+            snapshot_now()
+        except Exception as e:
+            print(f"Snapshot failed: {e}")
+
+def start_snapshotter():
+    if SNAPSHOT_INTERVAL:
+        threading.Thread(target=_snapshotter, name="snapshotter", daemon=True).start()
+        if STORAGE == "json":
+            atexit.register(_save_pending_changes)
+
+def read_manifest() -> tuple[dict, int]:
+    pinned = bot.get_chat(CHANNEL_ID).pinned_message
+    text = (pinned.text or "") if pinned else ""
+    if not text.startswith(SNAPSHOT_TAG + " manifest\n"):
+        raise RuntimeError("в канале нет закреплённого манифеста снапшотов")
+    return json.loads(text.split("\n", 1)[1]), pinned.message_id
+
+def _as_list(file_ids) -> list[str]:
+    # a manifest from before parts has one file_id per snapshot
+    return [file_ids] if isinstance(file_ids, str) else list(file_ids)
+
+def _download(file_ids) -> bytes:
+    # a snapshot's parts in order
+    return b"".join(bot.download_file(bot.get_file(fid).file_path) for fid in _as_list(file_ids))
+
+def restore_from_channel() -> dict:
+    # replaces the whole database with the latest full snapshot plus its deltas
+    global _snapshot_need_full
+    manifest, manifest_msg_id = read_manifest()
+    full = _download(manifest["full"])
+    deltas = [_download(ids) for ids in manifest["deltas"]]
+
+    flush_db()  # a rollback below must not take other pending writes along
+    with _snapshot_lock, db_tx():
+        if STORAGE == "sqlite":
+            target = db
+            for name in SQL_TABLES:
+                sql_conn.execute(f"DELETE FROM {name}")
+        else:
+            target = {name: {} for name in SQL_TABLES}
+        try:
+            records = 0
+            with gzip.GzipFile(fileobj=io.BytesIO(full)) as gz:
+                js = _JsonStream(io.TextIOWrapper(gz, encoding="utf-8"))
+                for section in js.keys():
+                    if section in SQL_TABLES and js.peek() == "{":
+                        for key in js.keys():
+                            target[section][key] = js.value()
+                            records += 1
+                    else:
+                        js.value()
+            for blob in deltas:
+                delta = json.loads(gzip.decompress(blob))
+                for section, recs in delta.get("set", {}).items():
+                    for key, rec in recs.items():
+                        target[section][key] = rec
+                for section, keys in delta.get("del", {}).items():
+                    for key in keys:
+                        target[section].pop(key, None)
+        except BaseException:
+            if STORAGE == "sqlite" and not SHARED_DB:
+                sql_conn.rollback()  # db_tx rolls back by itself with workers
+            raise
+
+        if STORAGE != "sqlite":
+            for name in SQL_TABLES:
+                db[name] = json_section(name, target[name])
+        db["settings"].setdefault("monthly_price_usd", DEFAULT_PRICE_USD)
+        if STORAGE == "sqlite":
+            sql_conn.execute("DELETE FROM changes")
+        else:
+            _changed.clear()
+        save_db(db)
+
+        _save_snapshot_state({
+            "full": {"file_ids": _as_list(manifest["full"]), "at": manifest.get("at"), "bytes": len(full), "records": records},
+            "deltas": [{"file_ids": _as_list(ids), "bytes": len(b)} for ids, b in zip(manifest["deltas"], deltas)],
+            "delta_bytes": sum(len(b) for b in deltas),
+            "manifest_msg_id": manifest_msg_id,
+        })
+        _snapshot_need_full = False
+
+    rebuild_indexes()
+    if STORAGE == "sqlite":
+        rebuild_search_sql(force=True)
+    clear_file_cache()
+    return {"records": records, "deltas": len(deltas), "at": manifest.get("at")}
+
+# =======================
+# OUTBOUND (rate-limited send queue)
+# =======================
+# User-facing sends go through one dispatcher: a global token bucket
+# (SEND_GLOBAL_RATE/s) plus a bucket per chat (SEND_CHAT_RATE/s for users,
+# SEND_GROUP_RATE/min for groups). Each chat is a FIFO, chats are served by
+# the priority of their head job, so interactive replies overtake bulk sends.
+# A 429 pauses the chat for retry_after and puts the job back in front.
+PRIO_INTERACTIVE = 0
+PRIO_BULK = 1
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        # seconds until one token is available (0 = now)
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+class _SendJob:
+    __slots__ = ("chat_id", "fn", "args", "kwargs", "priority", "seq", "future", "enqueued", "attempts")
+
+class Outbox:
+    def __init__(self, workers: int):
+        self.cond = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbox")
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self.buckets: dict = {}                # chat_id -> TokenBucket
+        self.pending: dict = {}                # chat_id -> deque[_SendJob]
+        self.busy: set = set()                 # chats with a request in flight
+        self.ready: list = []                  # heap (priority, seq, chat_id)
+        self.sleeping: list = []               # heap (wake_at, priority, seq, chat_id)
+        self.seq = 0
+        self.started = False
+        self.stats = {"sent": 0, "failed": 0, "retried_429": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+
+    def _bucket(self, chat_id):
+        b = self.buckets.get(chat_id)
+        if b is None:
+            if isinstance(chat_id, int) and chat_id < 0:
+                b = TokenBucket(SEND_GROUP_RATE, max(1.0, SEND_GROUP_RATE * 60))
+            else:
+                b = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+            self.buckets[chat_id] = b
+        return b
+
+    def _schedule_head(self, chat_id):
+        job = self.pending[chat_id][0]
+        heapq.heappush(self.ready, (job.priority, job.seq, chat_id))
+        self.cond.notify()
+
+    def submit(self, chat_id, fn, args, kwargs, priority: int) -> Future:
+        job = _SendJob()
+        job.chat_id, job.fn, job.args, job.kwargs, job.priority = chat_id, fn, args, kwargs, priority
+        job.future = Future()
+        job.enqueued = time.monotonic()
+        job.attempts = 0
+        with self.cond:
+            if not self.started:
+                self.started = True
+                threading.Thread(target=self._dispatch, name="outbox-dispatch", daemon=True).start()
+            self.seq += 1
+            job.seq = self.seq
+            q = self.pending.get(chat_id)
+            if q is None:
+                q = self.pending[chat_id] = deque()
+            q.append(job)
+            if len(q) == 1 and chat_id not in self.busy:
+                self._schedule_head(chat_id)
+        return job.future
+
+    def _dispatch(self):
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                while self.sleeping and self.sleeping[0][0] <= now:
+                    _, pri, seq, chat_id = heapq.heappop(self.sleeping)
+                    heapq.heappush(self.ready, (pri, seq, chat_id))
+                if not self.ready:
+                    self.cond.wait(self.sleeping[0][0] - now if self.sleeping else None)
+                    continue
+                g = self.global_bucket.delay(now)
+                if g > 0:
+                    self.cond.wait(g)
+                    continue
+                pri, seq, chat_id = heapq.heappop(self.ready)
+                d = self._bucket(chat_id).delay(now)
+                if d > 0:
+                    heapq.heappush(self.sleeping, (now + d, pri, seq, chat_id))
+                    continue
+                self.global_bucket.take()
+                self.buckets[chat_id].take()
+                job = self.pending[chat_id].popleft()
+                self.busy.add(chat_id)
+                wait_ms = (now - job.enqueued) * 1000
+                self.stats["wait_ms_total"] += wait_ms
+                self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], wait_ms)
+            self.pool.submit(self._run, job)
+
+    def _run(self, job: _SendJob):
+        retry_after = None
+        try:
+            result = job.fn(*job.args, **job.kwargs)
+        except apihelper.ApiTelegramException as e:
+            params = (getattr(e, "result_json", None) or {}).get("parameters") or {}
+            if e.error_code == 429 and job.attempts < 5:
+                retry_after = float(params.get("retry_after", 1))
+            else:
+                job.future.set_exception(e)
+        except Exception as e:
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+
+        with self.cond:
+            self.busy.discard(job.chat_id)
+            q = self.pending[job.chat_id]
+            if retry_after is not None:
+                job.attempts += 1
+                self.stats["retried_429"] += 1
+                q.appendleft(job)
+                self._bucket(job.chat_id).blocked_until = time.monotonic() + retry_after
+            elif job.future.exception() is None:
+                self.stats["sent"] += 1
+            else:
+                self.stats["failed"] += 1
+            if q:
+                self._schedule_head(job.chat_id)
+            else:
+                del self.pending[job.chat_id]
+                if len(self.buckets) > 10000:
+                    self._drop_idle_buckets()
+
+    def _drop_idle_buckets(self):
+        now = time.monotonic()
+        for chat_id, b in list(self.buckets.items()):
+            if chat_id not in self.pending and b.delay(now) == 0 and b.tokens >= b.capacity:
+                del self.buckets[chat_id]
+
+    def snapshot(self) -> dict:
+        with self.cond:
+            lanes = {PRIO_INTERACTIVE: 0, PRIO_BULK: 0}
+            for q in self.pending.values():
+                for job in q:
+                    lanes[job.priority] = lanes.get(job.priority, 0) + 1
+            done = self.stats["sent"] + self.stats["failed"]
+            return {
+                "depth_interactive": lanes[PRIO_INTERACTIVE],
+                "depth_bulk": lanes[PRIO_BULK],
+                "in_flight": len(self.busy),
+                **self.stats,
+                "wait_ms_avg": self.stats["wait_ms_total"] / done if done else 0.0,
+            }
+
+outbox = Outbox(SEND_WORKERS)
+
+def _collect_outbox():
+    for k, v in outbox.snapshot().items():
+        metrics.set("outbox_" + k, v)
+
+metrics.collectors.append(_collect_outbox)
+metrics.collectors.append(lambda: metrics.set(
+    "cryptopay_breaker_open", int(time.monotonic() < _crypto_breaker["open_until"])))
+
+def tg_send(chat_id, fn, *args, priority: int = PRIO_INTERACTIVE, wait: bool = True, **kwargs):
+    fut = outbox.submit(chat_id, fn, args, kwargs, priority)
+    return fut.result() if wait else fut
+
+def send_message(chat_id, text, priority: int = PRIO_INTERACTIVE, wait: bool = True, **kwargs):
+    return tg_send(chat_id, bot.send_message, chat_id, text, priority=priority, wait=wait, **kwargs)
+
+def send_document(chat_id, document, priority: int = PRIO_INTERACTIVE, wait: bool = True, **kwargs):
+    return tg_send(chat_id, bot.send_document, chat_id, document, priority=priority, wait=wait, **kwargs)
+
+def edit_message_text(text, chat_id, message_id, **kwargs):
+    return tg_send(chat_id, bot.edit_message_text, text, chat_id, message_id, **kwargs)
+
+# Handlers use the same queue: the rate-limited requests themselves run on
+# the outbox threads (SEND_GLOBAL_RATE caps them anyway). By default a handler
+# doesn't wait for the send: with ENGINE=sync that would hold one of the few
+# handler threads until the chat's bucket allows it. The chat's FIFO keeps
+# replies in order; wait=True returns the result (or raises) as before.
+def _report_send(fut: Future):
+    e = fut.exception()
+    if e is not None and "message is not modified" not in str(e):
+        print(f"Send failed: {e}")
+
+async def atg_send(chat_id, fn, *args, priority: int = PRIO_INTERACTIVE, wait: bool = False, **kwargs):
+    fut = outbox.submit(chat_id, fn, args, kwargs, priority)
+    if wait:
+        return await asyncio.wrap_future(fut)
+    fut.add_done_callback(_report_send)
+    return fut
+
+async def asend_message(chat_id, text, priority: int = PRIO_INTERACTIVE, wait: bool = False, **kwargs):
+    return await atg_send(chat_id, bot.send_message, chat_id, text, priority=priority, wait=wait, **kwargs)
+
+async def asend_document(chat_id, document, priority: int = PRIO_INTERACTIVE, wait: bool = False, **kwargs):
+    return await atg_send(chat_id, bot.send_document, chat_id, document, priority=priority, wait=wait, **kwargs)
+
+async def aedit_message_text(text, chat_id, message_id, wait: bool = False, **kwargs):
+    return await atg_send(chat_id, bot.edit_message_text, text, chat_id, message_id, wait=wait, **kwargs)
+
+async def tg_call(method: str, *args, **kwargs):
+    # Bot API calls outside the send queue (answerCallbackQuery, forwards)
+    if abot is None:
+        return getattr(bot, method)(*args, **kwargs)
+    labels = (("method", "".join(w.title() if i else w for i, w in enumerate(method.split("_")))),)
+    t0 = time.perf_counter()
+    try:
+        return await getattr(abot, method)(*args, **kwargs)
+    except Exception:
+        metrics.inc("telegram_api_errors_total", labels)
+        raise
+    finally:
+        metrics.observe("telegram_api_seconds", time.perf_counter() - t0, labels)
+
+# =======================
+# LIMITS (per-user token buckets)
+# =======================
+# Uploads, /pay and the chk: button each have a bucket per user (admins are
+# exempt). Buckets are kept in least-recently-used order: one that has been
+# idle for capacity/rate seconds is full again, so it is dropped from the
+# front as good as new; LIMIT_MAX_USERS caps the rest. With WORKERS > 1 a
+# private chat always lands on the same process, so its buckets do too.
+class UserLimiter:
+    def __init__(self, action: str, per_min: float, burst: float):
+        self.action = action
+        self.rate = float(per_min) / 60
+        self.capacity = max(1.0, float(burst))
+        self.idle = self.capacity / self.rate if self.rate > 0 else 0.0
+        self.buckets: OrderedDict = OrderedDict()  # user id -> TokenBucket, least recently used first
+        self.lock = threading.Lock()
+
+    def hit(self, user_id: int) -> float:
+        # 0 = allowed and counted, otherwise seconds until the next try passes
+        if self.rate <= 0 or is_admin(user_id):
+            return 0.0
+        now = time.monotonic()
+        with self.lock:
+            b = self.buckets.get(user_id)
+            if b is None:
+                b = self.buckets[user_id] = TokenBucket(self.rate, self.capacity)
+            else:
+                self.buckets.move_to_end(user_id)
+            wait = b.delay(now)
+            if not wait:
+                b.take()
+            while len(self.buckets) > LIMIT_MAX_USERS:
+                self.buckets.popitem(last=False)
+            while True:
+                uid, oldest = next(iter(self.buckets.items()))
+                if uid == user_id or now - oldest.stamp < self.idle:
+                    break
+                self.buckets.popitem(last=False)
+        if wait:
+            metrics.inc("rate_limited_total", (("action", self.action),))
+        return wait
+
+limit_upload = UserLimiter("upload", config["LIMIT_UPLOAD_PER_MIN"], config["LIMIT_UPLOAD_BURST"])
+limit_pay = UserLimiter("pay", config["LIMIT_PAY_PER_MIN"], config["LIMIT_PAY_BURST"])
+limit_check = UserLimiter("check", config["LIMIT_CHECK_PER_MIN"], config["LIMIT_CHECK_BURST"])
+
+def _collect_limits():
+    for limiter in (limit_upload, limit_pay, limit_check):
+        metrics.set("rate_limit_users", len(limiter.buckets), (("action", limiter.action),))
+
+metrics.collectors.append(_collect_limits)
+
+def slow_down_text(wait: float) -> str:
+    return f"⏳ Слишком часто. Попробуй через {int(wait) + 1} сек."
 
 # =======================
 # UI (no payment buttons anywhere except /pay)
@@ -243,64 +2886,91 @@ def admin_kb():
 
 admin_state = {}  # chat_id -> state
 
-def chunk(text: str, limit=3500):
-    parts = []
-    while len(text) > limit:
-        cut = text.rfind("\n", 0, limit)
-        if cut == -1:
-            cut = limit
-        parts.append(text[:cut])
-        text = text[cut:].lstrip("\n")
-    parts.append(text)
-    return parts
+USERS_PAGE = 20
+USER_FILTERS = {"a": "Все", "on": "Активные", "off": "Истёкшие"}
+
+def render_users_page(flt: str, offset: int):
+    total, users = users_page(flt, offset, USERS_PAGE)
+    title = f"поиск «{html.escape(flt[2:])}»" if flt.startswith("p:") else USER_FILTERS.get(flt, "Все")
+    lines = [f"👥 <b>Пользователи</b> — {title} ({total})"]
+    now = now_utc()
+    for u in users:
+        until = sub_until_dt(u)
+        mark = "✅" if until and until > now else "▫️"
+        lines.append(f"{mark} {html.escape(u.get('tag', '—'))} — <code>{u.get('id')}</code>")
+    if not users:
+        lines.append("Пользователей нет.")
+
+    kb = types.InlineKeyboardMarkup(row_width=4)
+    kb.row(*[
+        types.InlineKeyboardButton(("• " if k == flt else "") + v, callback_data=f"au:{k}:0")
+        for k, v in USER_FILTERS.items()
+    ], types.InlineKeyboardButton("🔎", callback_data="au:search"))
+    pages = max(1, (total + USERS_PAGE - 1) // USERS_PAGE)
+    if pages > 1:
+        page = offset // USERS_PAGE
+        kb.row(
+            types.InlineKeyboardButton(
+                "◀️", callback_data=f"au:{flt}:{offset - USERS_PAGE}" if offset > 0 else "au:noop"),
+            types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="au:noop"),
+            types.InlineKeyboardButton(
+                "▶️", callback_data=f"au:{flt}:{offset + USERS_PAGE}" if offset + USERS_PAGE < total else "au:noop"),
+        )
+    return "\n".join(lines), kb
+
+def clean_username_prefix(text: str) -> str:
+    return "".join(ch for ch in text.strip().lstrip("@") if ch.isalnum() or ch == "_")[:32]
 
 # =======================
 # COMMANDS
 # =======================
 @bot.message_handler(commands=["start"])
-def on_start(message: types.Message):
+@instrumented
+async def on_start(message: types.Message):
     user = ensure_user(message.from_user)
 
     args = message.text.split(maxsplit=1)
     if len(args) == 2:
         code = args[1].strip()
-        f = db["files"].get(code)
-        if not f:
-            bot.send_message(message.chat.id, "⚠️ Файл не найден или ссылка устарела.", reply_markup=menu_kb(user))
-            return
-
-        bot.send_message(
-            message.chat.id,
-            "ℹ️ <b>Файл</b>\n"
-            f"Имя: <code>{f.get('file_name','')}</code>\n"
-            f"Тип: <code>{f.get('mime_type','')}</code>\n"
-            f"Отправитель: <code>{f.get('u_tag','—')}</code>\n"
-            f"Дата: <code>{f.get('created_at','')}</code>\n\n"
-            "📦 Отправляю файл…"
-        )
-        bot.send_document(message.chat.id, f["file_id"])
+        hit = cached_file(code)
+        if not hit:
+            await asend_message(message.chat.id, "⚠️ Файл не найден или ссылка устарела.", reply_markup=menu_kb(user))
+            return
+        f, caption = hit
+        count_hit(code, f.get("u_id"))
+        send_stored_file(message.chat.id, code, f, caption)
         return
 
-    bot.send_message(
+    await asend_message(
         message.chat.id,
         "👋 <b>File Hosting</b>\n\n"
         "• Отправь мне файл — я дам ссылку.\n"
         "• По ссылке файл можно скачать.\n"
         "• Для загрузки файлов нужна подписка.\n\n"
         "💳 Оплата подписки: <code>/pay</code>\n"
-        "ℹ️ Инфо по файлу: <code>/file CODE</code>",
+        "📁 Мои файлы: <code>/myfiles</code>\n"
+        "ℹ️ Инфо по файлу: <code>/file CODE</code>\n"
+        f"🔎 Поиск по своим файлам: <code>@{bot_username()} имя</code>",
         reply_markup=menu_kb(user),
     )
 
 @bot.message_handler(commands=["pay"])
-def on_pay(message: types.Message):
+@instrumented
+async def on_pay(message: types.Message):
     user = ensure_user(message.from_user)
+    wait = limit_pay.hit(user["id"])
+    if wait:
+        await asend_message(message.chat.id, slow_down_text(wait))
+        return
     try:
-        invoice_id, pay_url = create_invoice_for_month(user["id"])
-        db["users"][str(user["id"])]["last_invoice"] = invoice_id
-        save_db(db)
+        invoice_id, pay_url = await create_invoice_for_month(user["id"])
+        with db_tx():
+            u = db["users"][str(user["id"])]
+            u["last_invoice"] = invoice_id
+            db["users"][str(user["id"])] = u
+            save_db(db)
 
-        bot.send_message(
+        await asend_message(
             message.chat.id,
             f"💳 <b>Подписка на 1 месяц</b>\n"
             f"Сумма: <b>${get_price():.2f}</b>\n\n"
@@ -308,22 +2978,25 @@ def on_pay(message: types.Message):
             reply_markup=pay_kb(invoice_id, pay_url)
         )
     except Exception as e:
-        bot.send_message(message.chat.id, f"❌ Не могу создать счёт.\n<code>{e}</code>")
+        await asend_message(message.chat.id, f"❌ Не могу создать счёт.\n<code>{e}</code>")
 
 @bot.message_handler(commands=["file"])
-def on_file(message: types.Message):
+@instrumented
+async def on_file(message: types.Message):
     user = ensure_user(message.from_user)
     parts = message.text.split(maxsplit=1)
     if len(parts) < 2:
-        bot.send_message(message.chat.id, "Пример: <code>/file CODE</code>")
+        await asend_message(message.chat.id, "Пример: <code>/file CODE</code>")
         return
     code = parts[1].strip()
-    f = db["files"].get(code)
+    f = get_file(code)
     if not f:
-        bot.send_message(message.chat.id, "❌ Файл не найден.")
+        await asend_message(message.chat.id, "❌ Файл не найден.")
         return
 
-    bot.send_message(
+    views, downloads = file_stats(code)
+    u_views, u_downloads = uploader_stats(f.get("u_id"))
+    await asend_message(
         message.chat.id,
         "ℹ️ <b>Информация о файле</b>\n"
         f"Код: <code>{code}</code>\n"
@@ -331,31 +3004,69 @@ def on_file(message: types.Message):
         f"Тип: <code>{f.get('mime_type','')}</code>\n"
         f"Отправитель: <code>{f.get('u_tag','—')}</code>\n"
         f"ID отправителя: <code>{f.get('u_id','')}</code>\n"
-        f"Дата: <code>{f.get('created_at','')}</code>"
+        f"Дата: <code>{f.get('created_at','')}</code>\n"
+        f"Просмотров: <b>{views}</b>, скачиваний: <b>{downloads}</b>\n"
+        f"Всего у отправителя: {u_views} просм., {u_downloads} скач."
     )
 
+MYFILES_PAGE = 10
+
+def render_myfiles(user_id: int, page: int):
+    total = user_file_count(user_id)
+    pages = max(1, (total + MYFILES_PAGE - 1) // MYFILES_PAGE)
+    page = min(max(0, page), pages - 1)
+    items = user_files(user_id, page * MYFILES_PAGE, MYFILES_PAGE)
+    if not items:
+        return "📁 У тебя пока нет загруженных файлов.", None
+
+    lines = [f"📁 <b>Мои файлы</b> ({total})"]
+    for code, f in items:
+        lines.append(f"• <code>{html.escape(f.get('file_name') or '—')}</code>\n  {file_link(code)}")
+    kb = None
+    if pages > 1:
+        kb = types.InlineKeyboardMarkup(row_width=3)
+        kb.row(
+            types.InlineKeyboardButton("◀️", callback_data=f"mf:{page - 1}" if page > 0 else "mf:noop"),
+            types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="mf:noop"),
+            types.InlineKeyboardButton("▶️", callback_data=f"mf:{page + 1}" if page < pages - 1 else "mf:noop"),
+        )
+    return "\n".join(lines), kb
+
+@bot.message_handler(commands=["myfiles"])
+@instrumented
+async def on_myfiles(message: types.Message):
+    user = ensure_user(message.from_user)
+    text, kb = render_myfiles(user["id"], 0)
+    await asend_message(message.chat.id, text, reply_markup=kb, disable_web_page_preview=True)
+
 @bot.message_handler(commands=["admin"])
-def on_admin_cmd(message: types.Message):
+@instrumented
+async def on_admin_cmd(message: types.Message):
     user = ensure_user(message.from_user)
     if not is_admin(user["id"]):
         return
-    bot.send_message(message.chat.id, "🛠 <b>Админ-панель</b>", reply_markup=admin_kb())
+    await asend_message(message.chat.id, "🛠 <b>Админ-панель</b>", reply_markup=admin_kb())
 
 @bot.message_handler(commands=["info"])
-def on_info(message: types.Message):
+@instrumented
+async def on_info(message: types.Message):
     user = ensure_user(message.from_user)
     if not is_admin(user["id"]):
         return
     parts = message.text.split(maxsplit=1)
     if len(parts) < 2:
-        bot.send_message(message.chat.id, "Пример: <code>/info CODE</code>")
+        await asend_message(message.chat.id, "Пример: <code>/info CODE</code>")
         return
     code = parts[1].strip()
-    f = db["files"].get(code)
+    f = get_file(code)
+    archived = None
     if not f:
-        bot.send_message(message.chat.id, "❌ Файл не найден.")
-        return
-    bot.send_message(
+        archived = archive_lookup("files", code)
+        if not archived:
+            await asend_message(message.chat.id, "❌ Файл не найден.")
+            return
+        f = archived["data"]
+    await asend_message(
         message.chat.id,
         "ℹ️ <b>Информация о файле (админ)</b>\n"
         f"Код: <code>{code}</code>\n"
@@ -365,47 +3076,292 @@ def on_info(message: types.Message):
         f"ID отправителя: <code>{f.get('u_id','')}</code>\n"
         f"Дата: <code>{f.get('created_at','')}</code>\n"
         f"Backup msg_id: <code>{f.get('backup_msg_id','—')}</code>"
+        + "".join(f"\nРеплика: <code>{r['chat']}</code> / <code>{r['msg_id']}</code>" for r in f.get("replicas", ()))
+        + (f"\nАлиас для: <code>{f['alias_of']}</code>" if f.get("alias_of") else "")
+        + ("" if archived else f"\nБэкап: {backup_status(code, f)}")
+        + (f"\n📦 В архиве с <code>{archived['archived_at']}</code>" if archived else "")
+    )
+
+@bot.message_handler(commands=["invoice"])
+@instrumented
+async def on_invoice(message: types.Message):
+    user = ensure_user(message.from_user)
+    if not is_admin(user["id"]):
+        return
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await asend_message(message.chat.id, "Пример: <code>/invoice ID</code>")
+        return
+    invoice_id = parts[1].strip()
+    inv = db["invoices"].get(invoice_id)
+    archived = None
+    if not inv:
+        archived = archive_lookup("invoices", invoice_id)
+        if not archived:
+            await asend_message(message.chat.id, "❌ Счёт не найден.")
+            return
+        inv = archived["data"]
+    await asend_message(
+        message.chat.id,
+        "🧾 <b>Счёт</b>\n"
+        f"ID: <code>{html.escape(invoice_id)}</code>\n"
+        f"Пользователь: <code>{inv.get('user_id', '—')}</code>\n"
+        f"Статус: <code>{inv.get('status', '—')}</code>\n"
+        f"Сумма: <code>${float(inv.get('amount_usd') or 0):.2f}</code>\n"
+        f"Создан: <code>{inv.get('created_at') or '—'}</code>\n"
+        f"Оплачен: <code>{inv.get('paid_at') or '—'}</code>\n"
+        f"Зачислен: <code>{inv.get('credited_at') or '—'}</code>"
+        + (f"\n📦 В архиве с <code>{archived['archived_at']}</code>" if archived else "")
+    )
+
+@bot.message_handler(commands=["sweep"])
+@instrumented
+async def on_sweep(message: types.Message):
+    user = ensure_user(message.from_user)
+    if not is_admin(user["id"]):
+        return
+    r = await asyncio.to_thread(sweep)
+    await asend_message(
+        message.chat.id,
+        "🧹 <b>Архивация</b>\n"
+        f"Счетов: <b>{r['invoices']}</b>, файлов: <b>{r['files']}</b>\n"
+        f"Освобождено: <b>{r['reclaimed_bytes'] / 1024:.1f} КБ</b>, "
+        f"архив +{r['archive_bytes'] / 1024:.1f} КБ, {r['seconds']} с"
+    )
+
+# Records saved before dedup have no file_unique_id: ask Telegram for it
+# (getFile) in the background. Files over 20 MB can't be resolved by the Bot
+# API and are marked with "" so they are not retried.
+_dedup_backfill_running = threading.Event()
+
+def _codes_missing_unique(limit: int) -> list[str]:
+    if STORAGE == "sqlite":
+        return [k for k, _ in db["files"].rows(
+            "file_unique_id IS NULL AND json_extract(data, '$.alias_of') IS NULL", limit=limit)]
+    with db_lock:
+        return [c for c, f in db["files"].items() if "file_unique_id" not in f and not f.get("alias_of")][:limit]
+
+def dedup_backfill(chat_id: int, rate: float = 10.0):
+    done = failed = 0
+    try:
+        while True:
+            codes = _codes_missing_unique(500)
+            if not codes:
+                break
+            for code in codes:
+                f = db["files"].get(code)
+                if not f:
+                    continue
+                try:
+                    fuid = bot.get_file(f["file_id"]).file_unique_id
+                    done += 1
+                except Exception:
+                    fuid = ""
+                    failed += 1
+                with db_tx():
+                    f = db["files"].get(code)
+                    if f is not None:
+                        f["file_unique_id"] = fuid
+                        db["files"][code] = f
+                        invalidate_file(code)
+                        index_unique(code, f)
+                        save_db(db)
+                time.sleep(1 / rate)
+        send_message(chat_id, f"✅ Дедупликация: проиндексировано <b>{done}</b>, не удалось <b>{failed}</b>.", wait=False)
+    finally:
+        _dedup_backfill_running.clear()
+
+@bot.message_handler(commands=["dedup_backfill"])
+@instrumented
+async def on_dedup_backfill(message: types.Message):
+    user = ensure_user(message.from_user)
+    if not is_admin(user["id"]):
+        return
+    if _dedup_backfill_running.is_set():
+        await asend_message(message.chat.id, "⏳ Уже выполняется.")
+        return
+    _dedup_backfill_running.set()
+    threading.Thread(target=dedup_backfill, args=(message.chat.id,), name="dedup-backfill", daemon=True).start()
+    await asend_message(message.chat.id, "⏳ Запустил индексацию file_unique_id для старых файлов.")
+
+def render_metrics_summary() -> str:
+    metrics.render()  # refresh gauges
+    lines = ["📈 <b>Метрики</b>"]
+
+    def section(title: str, hist: str, errors: str):
+        rows = sorted(metrics.hist_summary(hist).items(), key=lambda kv: -kv[1][1])
+        if not rows:
+            return
+        errs = metrics.counter_values(errors)
+        lines.append(f"\n<b>{title}</b> (вызовы · ср. · p99 · ошибки)")
+        for labels, (count, total) in rows[:12]:
+            name = labels[0][1] if labels else "—"
+            p99 = metrics.quantile(hist, labels, 0.99)
+            lines.append(
+                f"<code>{html.escape(name)}</code>: {count} · {total / count * 1000:.0f} мс · "
+                f"≤{p99 * 1000:.0f} мс · {int(errs.get(labels, 0))}"
+            )
+
+    section("Хендлеры", "bot_handler_seconds", "bot_handler_errors_total")
+    section("Telegram API", "telegram_api_seconds", "telegram_api_errors_total")
+    section("Crypto Pay", "cryptopay_api_seconds", "cryptopay_api_errors_total")
+
+    flush = metrics.hist_summary("db_flush_seconds").get((), (0, 0.0))
+    ob = outbox.snapshot()
+    lines.append(
+        "\n<b>Прочее</b>\n"
+        f"БД: {db_size_bytes() / 1024 / 1024:.1f} МБ, сбросов {flush[0]}"
+        + (f", ср. {flush[1] / flush[0] * 1000:.0f} мс" if flush[0] else "") + "\n"
+        f"Хендлеров в работе: {_in_flight[0]}\n"
+        f"Очередь отправки: {ob['depth_interactive']} + {ob['depth_bulk']} (bulk), "
+        f"ожидание ср. {ob['wait_ms_avg']:.0f} мс, 429: {ob['retried_429']}\n"
+        f"Очередь бэкапа: {len(db['backups'])}, не удалось: {len(db['backups_failed'])}"
+    )
+    if _last_sweep:
+        lines.append(
+            f"Архивация {_last_sweep['at'][:16]}: счетов {_last_sweep['invoices']}, файлов {_last_sweep['files']}, "
+            f"счётчиков {_last_sweep['stats']}, "
+            f"освобождено {_last_sweep['reclaimed_bytes'] / 1024:.1f} КБ"
+        )
+    return "\n".join(lines)
+
+@bot.message_handler(commands=["metrics"])
+@instrumented
+async def on_metrics(message: types.Message):
+    user = ensure_user(message.from_user)
+    if not is_admin(user["id"]):
+        return
+    await asend_message(message.chat.id, render_metrics_summary())
+
+@bot.message_handler(commands=["profile"])
+@instrumented
+async def on_profile(message: types.Message):
+    user = ensure_user(message.from_user)
+    if not is_admin(user["id"]):
+        return
+    arg = (message.text.split(maxsplit=1)[1:] or [""])[0].strip().lower()
+    if arg == "on":
+        started = profiler_start()
+        await asend_message(message.chat.id, "🔬 Профайлер включён." if started else "🔬 Профайлер уже работает.")
+        return
+    if arg == "off":
+        profiler_stop()
+    report = io.BytesIO(profiler_report().encode())
+    report.name = "profile.txt"
+    await asend_document(message.chat.id, report, caption="🔬 Горячие стеки" + (" (профайлер выключен)" if arg == "off" else ""))
+
+@bot.message_handler(commands=["snapshot"])
+@instrumented
+async def on_snapshot(message: types.Message):
+    user = ensure_user(message.from_user)
+    if not is_admin(user["id"]):
+        return
+    state = _load_snapshot_state()
+    if WORKER_INDEX is not None:
+        await asend_message(
+            message.chat.id,
+            f"💾 Снапшоты делает основной процесс раз в {SNAPSHOT_INTERVAL:.0f} с.\n"
+            f"Последний полный: <code>{(state.get('full') or {}).get('at', '—')}</code>, "
+            f"дельт после него: <b>{len(state.get('deltas', []))}</b>"
+        )
+        return
+    full = "full" in message.text.lower()
+    try:
+        r = await asyncio.to_thread(snapshot_now, full)
+    except Exception as e:
+        await asend_message(message.chat.id, f"❌ Снапшот не удался.\n<code>{html.escape(str(e))}</code>")
+        return
+    if not r["kind"]:
+        await asend_message(message.chat.id, "💾 Изменений с прошлого снапшота нет.")
+        return
+    await asend_message(
+        message.chat.id,
+        f"💾 Снапшот ({'полный' if r['kind'] == 'full' else 'дельта'}): записей <b>{r['records']}</b>, "
+        f"{r['bytes'] / 1024:.1f} КБ" + (f" в {r['parts']} частях" if r["parts"] > 1 else "")
+        + f", дельт в цепочке: <b>{r['deltas']}</b>"
+    )
+
+@bot.message_handler(commands=["restore"])
+@instrumented
+async def on_restore(message: types.Message):
+    user = ensure_user(message.from_user)
+    if not is_admin(user["id"]):
+        return
+    if WORKER_INDEX is not None:
+        # other workers would keep serving their caches and indexes of the old base
+        await asend_message(
+            message.chat.id,
+            "♻️ С WORKERS > 1 восстановление недоступно: останови бота, запусти с WORKERS=1, "
+            "выполни /restore и верни WORKERS."
+        )
+        return
+    if message.text.split()[1:2] != ["yes"]:
+        await asend_message(
+            message.chat.id,
+            "⚠️ База будет заменена последним снапшотом из канала бэкапа.\n"
+            "Подтверди: <code>/restore yes</code>"
+        )
+        return
+    await asend_message(message.chat.id, "⏳ Восстанавливаю…")
+    try:
+        r = await asyncio.to_thread(restore_from_channel)
+    except Exception as e:
+        await asend_message(message.chat.id, f"❌ Восстановление не удалось.\n<code>{html.escape(str(e))}</code>")
+        return
+    await asend_message(
+        message.chat.id,
+        f"✅ Восстановлено записей: <b>{r['records']}</b> + дельт: <b>{r['deltas']}</b>\n"
+        f"Снапшот от <code>{r['at']}</code>"
     )
 
 # =======================
 # CALLBACKS
 # =======================
 @bot.callback_query_handler(func=lambda c: True)
-def on_cb(call: types.CallbackQuery):
+@instrumented
+async def on_cb(call: types.CallbackQuery):
     user = ensure_user(call.from_user)
     data = call.data or ""
 
     # payment check (only from /pay message button)
     if data.startswith("chk:"):
         invoice_id = data.split("chk:", 1)[1].strip()
-        try:
-            inv = get_invoice_status(invoice_id)
-            if not inv:
-                bot.answer_callback_query(call.id, "Счёт не найден", show_alert=True)
-                return
+        wait = limit_check.hit(user["id"])
+        if wait:
+            await tg_call("answer_callback_query", call.id, slow_down_text(wait), show_alert=True)
+            return
+        inv = db["invoices"].get(invoice_id)
+        if not inv:
+            await tg_call("answer_callback_query", call.id, "Счёт не найден", show_alert=True)
+            return
 
-            status = inv.get("status", "unknown")
-            db["invoices"].setdefault(invoice_id, {})
-            db["invoices"][invoice_id]["status"] = status
-            db["invoices"][invoice_id]["checked_at"] = dt_to_iso(now_utc())
-            save_db(db)
+        status = inv.get("status", "unknown")
+        if status == "paid":
+            await tg_call("answer_callback_query", call.id, "Оплата найдена ✅ Подписка активирована.", show_alert=True)
+        elif status == "expired":
+            await tg_call("answer_callback_query", call.id, "Счёт истёк. Создай новый: /pay", show_alert=True)
+        else:
+            _reconcile_wakeup.set()
+            await tg_call(
+                "answer_callback_query", call.id,
+                "Оплата пока не найдена. Как только она поступит — пришлю уведомление.", show_alert=True
+            )
+        return
 
-            if status == "paid":
-                extend_sub(user["id"], days=30)
-                u = db["users"].get(str(user["id"]), user)
-                bot.answer_callback_query(call.id, "Оплата найдена ✅", show_alert=True)
-                bot.send_message(call.message.chat.id, f"✅ Подписка активирована.\n{fmt_sub(u)}")
-            else:
-                bot.answer_callback_query(call.id, f"Статус: {status}", show_alert=True)
-        except Exception as e:
-            bot.answer_callback_query(call.id, "Ошибка проверки", show_alert=True)
-            bot.send_message(call.message.chat.id, f"❌ Ошибка проверки.\n<code>{e}</code>")
+    if data.startswith("mf:"):
+        await tg_call("answer_callback_query", call.id)
+        page = data[3:]
+        if page.isdigit():
+            text, kb = render_myfiles(user["id"], int(page))
+            await aedit_message_text(
+                text, call.message.chat.id, call.message.message_id, reply_markup=kb, disable_web_page_preview=True
+            )
         return
 
     if data == "profile":
-        bot.answer_callback_query(call.id)
+        await tg_call("answer_callback_query", call.id)
         u = db["users"].get(str(user["id"]), user)
-        bot.send_message(
+        await asend_message(
             call.message.chat.id,
             "👤 <b>Профиль</b>\n"
             f"ID: <code>{u['id']}</code>\n"
@@ -418,56 +3374,70 @@ def on_cb(call: types.CallbackQuery):
 
     if data == "admin":
         if not is_admin(user["id"]):
-            bot.answer_callback_query(call.id, "Нет доступа", show_alert=True)
+            await tg_call("answer_callback_query", call.id, "Нет доступа", show_alert=True)
             return
-        bot.answer_callback_query(call.id)
-        bot.send_message(call.message.chat.id, "🛠 <b>Админ-панель</b>", reply_markup=admin_kb())
+        await tg_call("answer_callback_query", call.id)
+        await asend_message(call.message.chat.id, "🛠 <b>Админ-панель</b>", reply_markup=admin_kb())
         return
 
     if data == "adm:users":
         if not is_admin(user["id"]):
-            bot.answer_callback_query(call.id, "Нет доступа", show_alert=True)
+            await tg_call("answer_callback_query", call.id, "Нет доступа", show_alert=True)
             return
-        bot.answer_callback_query(call.id)
-        users = list(db["users"].values())
-        users.sort(key=lambda x: int(x.get("id", 0)))
-        lines = ["👥 <b>Пользователи</b>"]
-        for u in users[:3000]:
-            lines.append(f"• {u.get('tag','—')} — <code>{u.get('id')}</code>")
-        txt = "\n".join(lines) if users else "Пользователей нет."
-        for part in chunk(txt):
-            bot.send_message(call.message.chat.id, part)
+        await tg_call("answer_callback_query", call.id)
+        text, kb = render_users_page("a", 0)
+        await asend_message(call.message.chat.id, text, reply_markup=kb)
+        return
+
+    if data.startswith("au:"):
+        if not is_admin(user["id"]):
+            await tg_call("answer_callback_query", call.id, "Нет доступа", show_alert=True)
+            return
+        await tg_call("answer_callback_query", call.id)
+        if data == "au:search":
+            admin_state[str(call.message.chat.id)] = "await_user_prefix"
+            await asend_message(call.message.chat.id, "🔎 Начало username (без @):")
+            return
+        flt, _, offset = data[3:].rpartition(":")
+        if not flt or not offset.isdigit():
+            return
+        text, kb = render_users_page(flt, int(offset))
+        await aedit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=kb)
         return
 
     if data == "adm:stats":
         if not is_admin(user["id"]):
-            bot.answer_callback_query(call.id, "Нет доступа", show_alert=True)
+            await tg_call("answer_callback_query", call.id, "Нет доступа", show_alert=True)
             return
-        bot.answer_callback_query(call.id)
-        users = list(db["users"].values())
-        active = 0
-        for u in users:
-            until = iso_to_dt(u.get("sub_until"))
-            if until and until > now_utc():
-                active += 1
-        bot.send_message(
-            call.message.chat.id,
+        await tg_call("answer_callback_query", call.id)
+        flush_stats()
+        lines = [
             "📊 <b>Статистика</b>\n"
-            f"Пользователей: <b>{len(users)}</b>\n"
-            f"Активных подписок: <b>{active}</b>\n"
+            f"Пользователей: <b>{len(db['users'])}</b>\n"
+            f"Активных подписок: <b>{count_active_subs()}</b>\n"
+            f"Истекают за 7 дней: <b>{count_expiring_subs(7)}</b>\n"
             f"Файлов: <b>{len(db['files'])}</b>\n"
             f"Инвойсов: <b>{len(db['invoices'])}</b>\n"
             f"Цена: <b>${get_price():.2f}</b>/мес"
-        )
+        ]
+        top = top_files(5)
+        if top:
+            lines.append("\n<b>Топ файлов</b> (скачивания · просмотры)")
+            lines += [f"<code>{html.escape(str(c))}</code>: {d} · {v}" for c, v, d in top]
+        top = top_uploaders(5)
+        if top:
+            lines.append("\n<b>Топ отправителей</b>")
+            lines += [f"<code>{u}</code>: {d} · {v}" for u, v, d in top]
+        await asend_message(call.message.chat.id, "\n".join(lines))
         return
 
     if data == "adm:price":
         if not is_admin(user["id"]):
-            bot.answer_callback_query(call.id, "Нет доступа", show_alert=True)
+            await tg_call("answer_callback_query", call.id, "Нет доступа", show_alert=True)
             return
-        bot.answer_callback_query(call.id)
+        await tg_call("answer_callback_query", call.id)
         admin_state[str(call.message.chat.id)] = "await_price"
-        bot.send_message(
+        await asend_message(
             call.message.chat.id,
             f"💵 Текущая цена: <b>${get_price():.2f}</b>\n"
             "Отправь новую цену числом (пример: <code>0.5</code>)"
@@ -476,20 +3446,50 @@ def on_cb(call: types.CallbackQuery):
 
     if data == "adm:grant":
         if not is_admin(user["id"]):
-            bot.answer_callback_query(call.id, "Нет доступа", show_alert=True)
+            await tg_call("answer_callback_query", call.id, "Нет доступа", show_alert=True)
             return
-        bot.answer_callback_query(call.id)
+        await tg_call("answer_callback_query", call.id)
         admin_state[str(call.message.chat.id)] = "await_grant_user"
-        bot.send_message(call.message.chat.id, "ID пользователя, кому выдать подписку (30 дней).")
+        await asend_message(call.message.chat.id, "ID пользователя, кому выдать подписку (30 дней).")
         return
 
-    bot.answer_callback_query(call.id)
+    await tg_call("answer_callback_query", call.id)
+
+# =======================
+# INLINE (file search: @bot query)
+# =======================
+# Users search their own uploads, the admin searches everyone's (an empty
+# query lists the caller's latest files). Pages of SEARCH_PAGE results.
+@bot.inline_handler(func=lambda q: True)
+@instrumented
+async def on_inline(query: types.InlineQuery):
+    user = ensure_user(query.from_user)
+    text = (query.query or "").strip()
+    offset = int(query.offset) if (query.offset or "").isdigit() else 0
+    owner = None if text and is_admin(user["id"]) else user["id"]
+    found = cached_search(text, owner, offset, SEARCH_PAGE + 1)
+    results = [
+        types.InlineQueryResultCachedDocument(
+            id=code,
+            title=f.get("file_name") or code,
+            document_file_id=f["file_id"],
+            description=f"{f.get('mime_type') or '—'} · {f.get('u_tag', '—')} · {f.get('created_at', '')}",
+            caption=download_caption(f),
+            parse_mode="HTML",
+        )
+        for code, f in found[:SEARCH_PAGE]
+    ]
+    await tg_call(
+        "answer_inline_query", query.id, results, cache_time=INLINE_CACHE_TIME, is_personal=True,
+        next_offset=str(offset + SEARCH_PAGE) if len(found) > SEARCH_PAGE else "",
+    )
 
 # =======================
 # ADMIN INPUT
 # =======================
 @bot.message_handler(content_types=["text"])
-def on_text(message: types.Message):
+@instrumented
+async def on_text(message: types.Message):
     user = ensure_user(message.from_user)
     st = admin_state.get(str(message.chat.id))
 
@@ -498,97 +3498,829 @@ def on_text(message: types.Message):
             price = float(message.text.strip().replace(",", "."))
             if price <= 0:
                 raise ValueError
-            db["settings"]["monthly_price_usd"] = price
-            save_db(db)
+            with db_tx(immediate=False):
+                db["settings"]["monthly_price_usd"] = price
+                save_db(db)
             admin_state.pop(str(message.chat.id), None)
-            bot.send_message(message.chat.id, f"✅ Цена обновлена: <b>${price:.2f}</b> / мес", reply_markup=admin_kb())
+            await asend_message(message.chat.id, f"✅ Цена обновлена: <b>${price:.2f}</b> / мес", reply_markup=admin_kb())
         except Exception:
-            bot.send_message(message.chat.id, "❌ Не понял цену. Пример: <code>0.5</code>")
+            await asend_message(message.chat.id, "❌ Не понял цену. Пример: <code>0.5</code>")
         return
 
     if st == "await_grant_user" and is_admin(user["id"]):
         try:
             target_id = int(message.text.strip())
-            target = db["users"].get(str(target_id)) or {
-                "id": target_id, "username": "", "tag": "—", "sub_until": None, "last_invoice": None
-            }
-            db["users"][str(target_id)] = target
-            save_db(db)
+            with db_tx():
+                target = db["users"].get(str(target_id)) or {
+                    "id": target_id, "username": "", "tag": "—", "sub_until": None, "last_invoice": None
+                }
+                db["users"][str(target_id)] = target
+                save_db(db)
             until = extend_sub(target_id, days=30)
             admin_state.pop(str(message.chat.id), None)
-            bot.send_message(
+            await asend_message(
                 message.chat.id,
                 f"✅ Подписка выдана <code>{target_id}</code> до <code>{until.strftime('%Y-%m-%d %H:%M UTC')}</code>",
                 reply_markup=admin_kb()
             )
         except Exception:
-            bot.send_message(message.chat.id, "❌ Неверный ID. Пришли числом.")
+            await asend_message(message.chat.id, "❌ Неверный ID. Пришли числом.")
+        return
+
+    if st == "await_user_prefix" and is_admin(user["id"]):
+        prefix = clean_username_prefix(message.text)
+        if not prefix:
+            await asend_message(message.chat.id, "❌ Пришли начало username, например: <code>ivan</code>")
+            return
+        admin_state.pop(str(message.chat.id), None)
+        text, kb = render_users_page("p:" + prefix, 0)
+        await asend_message(message.chat.id, text, reply_markup=kb)
         return
 
     if message.text.strip().lower() in ("меню", "/menu"):
-        bot.send_message(message.chat.id, "Меню:", reply_markup=menu_kb(user))
+        await asend_message(message.chat.id, "Меню:", reply_markup=menu_kb(user))
         return
 
 # =======================
-# UPLOAD (backup to group/channel is mandatory)
+# BACKUP QUEUE (CHANNEL_ID list)
 # =======================
-@bot.message_handler(content_types=["document"])
-def on_upload(message: types.Message):
-    user = ensure_user(message.from_user)
+# An upload is stored and answered at once with the sender's file_id; its
+# backup copies are jobs in db["backups"] (code -> source message), written in
+# the same transaction as the record, so a crash can't lose one. A drainer
+# thread in every process claims due jobs for BACKUP_LEASE seconds (a claim by
+# a process that died runs again after it) and forwards each batch (an album)
+# to all backup chats at once on a thread pool. Every copy is added to the
+# record as it arrives: "replicas" lists them all ([{"chat", "msg_id",
+# "file_id"}]) and the first one also becomes file_id/backup_chat/
+# backup_msg_id. A job is done once BACKUP_QUORUM chats hold a copy; a failed
+# one is retried after BACKUP_RETRY_BASE * 2^n seconds (at most
+# BACKUP_RETRY_MAX), forwarding only to the chats still missing it, and
+# after BACKUP_MAX_ATTEMPTS it moves to db["backups_failed"] for /info.
+# A source message the user has deleted is replaced by sending its file_id.
+_backup_pool = ThreadPoolExecutor(max_workers=BACKUP_WORKERS, thread_name_prefix="backup")
+_backup_wakeup = threading.Event()
+_backup_lock = threading.Lock()
+_backup_in_flight = [0]  # batches being forwarded by this process
 
-    if not (is_admin(user["id"]) or has_active_sub(user)):
-        bot.send_message(
-            message.chat.id,
-            "🔒 <b>Загрузка доступна по подписке.</b>\n"
-            f"Цена: <b>${get_price():.2f}</b> / месяц\n\n"
-            "Оплата подписки: <code>/pay</code>"
-        )
-        return
+metrics.collectors.append(lambda: metrics.set("backup_queue_jobs", len(db["backups"])))
+metrics.collectors.append(lambda: metrics.set("backup_failed_jobs", len(db["backups_failed"])))
 
-    code = gen_code()
-    doc = message.document
+def backup_job(message: types.Message, batch: str) -> dict:
+    # batch: jobs of one album share it and are forwarded together
+    return {
+        "chat": message.chat.id,
+        "msg_id": message.message_id,
+        "file_id": message.document.file_id,
+        "batch": batch,
+        "due": time.time(),
+        "attempts": 0,
+    }
+
+def _copy_one(chat_id: str, job: dict):
+    try:
+        return bot.forward_message(chat_id, job["chat"], job["msg_id"])
+    except apihelper.ApiTelegramException as e:
+        if e.error_code != 400:
+            raise
+        # 400: the source message is gone (deleted by the user); the file isn't
+        metrics.inc("backup_resend_total")
+        return bot.send_document(chat_id, job["file_id"], disable_notification=True)
+
+def _forward_copies(chat_id: str, jobs: list[dict]) -> list[dict]:
+    # one copy of every job's message in chat_id, in order
+    if len(jobs) == 1:
+        copies = [_copy_one(chat_id, jobs[0])]
+    else:
+        try:
+            copies = bot.forward_messages(chat_id, jobs[0]["chat"], [j["msg_id"] for j in jobs])
+        except apihelper.ApiTelegramException as e:
+            if e.error_code != 400:
+                raise
+            copies = []
+        if len(copies) != len(jobs):
+            # Telegram skips messages it can't forward: redo them one by one
+            copies = [_copy_one(chat_id, j) for j in jobs]
+    # forwardMessages returns only message ids: keep the sender's file_id then
+    return [
+        {
+            "chat": chat_id,
+            "msg_id": c.message_id,
+            "file_id": c.document.file_id if getattr(c, "document", None) else j["file_id"],
+        }
+        for j, c in zip(jobs, copies)
+    ]
+
+class Replication:
+    # Forwards one batch to chat_ids and adds each chat's copies to the
+    # records. .quorum resolves once `need` chats have them, or fails with
+    # the last error once it can't.
+    def __init__(self, codes: list, jobs: list[dict], chat_ids: list, need: int):
+        self.codes = codes
+        self.need = need
+        self.left = len(chat_ids)
+        self.ok = 0
+        self.lock = threading.Lock()
+        self.quorum = Future()
+        for chat_id in chat_ids:
+            _backup_pool.submit(_forward_copies, chat_id, jobs).add_done_callback(
+                functools.partial(self._done, chat_id)
+            )
+
+    def _done(self, chat_id, fut: Future):
+        err = fut.exception()
+        if not err:
+            try:
+                add_replicas(self.codes, [[r] for r in fut.result()])
+            except Exception as e:
+                err = e
+        metrics.inc("backup_copies_total", (("result", "failed" if err else "ok"),))
+        if err:
+            print(f"Backup to {chat_id} failed: {err}")
+        with self.lock:
+            self.left -= 1
+            self.ok += not err
+            if self.quorum.done():
+                return
+            if self.ok >= self.need:
+                self.quorum.set_result(self.ok)
+            elif self.ok + self.left < self.need:
+                self.quorum.set_exception(err)
+
+def add_replicas(codes: list, replicas: list[list[dict]]):
+    with db_tx():
+        for code, reps in zip(codes, replicas):
+            f = db["files"].get(code)
+            if f is None:
+                continue
+            have = {r["chat"] for r in f.get("replicas", ())}
+            f["replicas"] = f.get("replicas", []) + [r for r in reps if r["chat"] not in have]
+            if not f.get("backup_chat") and f["replicas"]:
+                # first copy: serve the backup's file_id instead of the sender's
+                first = f["replicas"][0]
+                f["file_id"], f["backup_chat"], f["backup_msg_id"] = first["file_id"], first["chat"], first["msg_id"]
+            db["files"][code] = f
+            invalidate_file(code)
+        save_db(db)
+
+def backup_chats(f: dict) -> set:
+    # backup chats holding a copy (records from before replicas: backup_chat only)
+    chats = {r["chat"] for r in f.get("replicas", ())} or {f.get("backup_chat")}
+    return chats & set(CHANNEL_IDS)
 
-    # 1) MUST forward to backup chat/channel
+def put_backup_job(code: str, job: dict):
+    # under db_tx
+    db["backups"][code] = job
+    if STORAGE != "sqlite":
+        heapq.heappush(backups_due, (job["due"], code))
+
+def _pop_due_backups(now: float, limit: int) -> list[tuple[str, dict]]:
+    # JSON: due jobs from the heap, under db_tx
+    due, seen = [], set()
+    while backups_due and backups_due[0][0] <= now and len(due) < limit:
+        at, code = heapq.heappop(backups_due)
+        job = db["backups"].get(code)
+        if job is not None and job["due"] == at and code not in seen:
+            seen.add(code)
+            due.append((code, job))
+    return due
+
+def claim_backups(limit: int) -> list[tuple[str, dict]]:
+    now = time.time()
+    with db_tx():
+        if STORAGE == "sqlite":
+            due = list(db["backups"].find("due <= ?", (now,), order="due", limit=limit))
+        else:
+            due = _pop_due_backups(now, limit)
+        due = [(code, {**job, "due": now + BACKUP_LEASE}) for code, job in due]
+        for code, job in due:
+            put_backup_job(code, job)
+        if due:
+            save_db(db)
+    return due
+
+def finish_backups(codes: list, err: Exception | None):
+    now = time.time()
+    failed = 0
+    with db_tx():
+        for code in codes:
+            job = db["backups"].get(code)
+            if job is None:
+                continue
+            if err is None:
+                del db["backups"][code]
+                continue
+            job["attempts"] = job.get("attempts", 0) + 1
+            job["error"] = str(err)[:300]
+            if job["attempts"] >= BACKUP_MAX_ATTEMPTS:
+                # given up: out of the queue, shown as failed in /info
+                del db["backups"][code]
+                db["backups_failed"][code] = {**job, "failed_at": dt_to_iso(now_utc())}
+                failed += 1
+                continue
+            delay = min(BACKUP_RETRY_MAX, BACKUP_RETRY_BASE * 2 ** (job["attempts"] - 1))
+            job["due"] = now + delay * random.uniform(0.8, 1.2)
+            put_backup_job(code, job)
+        save_db(db)
+    if failed:
+        metrics.inc("backup_jobs_total", (("result", "failed"),), failed)
+    metrics.inc("backup_jobs_total", (("result", "retry" if err else "done"),), len(codes) - failed)
+
+def _batch_done(codes: list, fut: Future):
     try:
-        forwarded = bot.forward_message(CHANNEL_ID, message.chat.id, message.message_id)
+        finish_backups(codes, fut.exception())
     except Exception as e:
-        bot.send_message(
-            message.chat.id,
-            "❌ Не смог переслать файл в backup-группу/канал.\n"
-            "Проверь: бот добавлен в группу/канал и имеет права.\n\n"
-            f"<code>{e}</code>"
-        )
+        print(f"Backup queue update failed: {e}")  # the lease runs out and the batch goes again
+    with _backup_lock:
+        _backup_in_flight[0] -= 1
+    _backup_wakeup.set()
+
+def start_backup_batch(batch: list[tuple[str, dict]]):
+    batch.sort(key=lambda kv: kv[1]["msg_id"])
+    codes, jobs, missing, need = [], [], set(), 0
+    for code, job in batch:
+        f = db["files"].get(code)
+        if f is None:  # deleted or archived meanwhile
+            finish_backups([code], None)
+            continue
+        have = backup_chats(f)
+        codes.append(code)
+        jobs.append(job)
+        missing |= set(CHANNEL_IDS) - have
+        need = max(need, BACKUP_QUORUM - len(have))
+    if not codes or need <= 0:
+        finish_backups(codes, None)
         return
+    with _backup_lock:
+        _backup_in_flight[0] += 1
+    replication = Replication(codes, jobs, [c for c in CHANNEL_IDS if c in missing], need)
+    replication.quorum.add_done_callback(functools.partial(_batch_done, codes))
 
-    # 2) store file_id (prefer forwarded document file_id)
-    backup_file_id = None
-    try:
-        if getattr(forwarded, "document", None):
-            backup_file_id = forwarded.document.file_id
-    except Exception:
-        backup_file_id = None
+def drain_backups() -> int:
+    # starts due batches while fewer than BACKUP_WORKERS are in flight
+    with _backup_lock:
+        room = BACKUP_WORKERS - _backup_in_flight[0]
+    if room <= 0:
+        return 0
+    batches: dict = {}
+    for code, job in claim_backups(room * 10):
+        batches.setdefault((job["chat"], job.get("batch") or code), []).append((code, job))
+    for batch in batches.values():
+        start_backup_batch(batch)
+    return len(batches)
+
+def _backup_drainer():
+    while True:
+        _backup_wakeup.wait(BACKUP_POLL)
+        _backup_wakeup.clear()
+        try:
+            drain_backups()
+        except Exception as e:
+            print(f"Backup queue failed: {e}")
+
+def start_backup_queue():
+    threading.Thread(target=_backup_drainer, name="backup-queue", daemon=True).start()
+
+def backup_status(code: str, f: dict) -> str:
+    code = f.get("alias_of") or code
+    copies = f"{len(backup_chats(f))}/{len(CHANNEL_IDS)}"
+    failed = db["backups_failed"].get(code)
+    if failed is not None:
+        return (
+            f"❌ бэкап не удался после {failed.get('attempts', 0)} попыток, копий {copies}"
+            + (f"\nОшибка: <code>{html.escape(failed['error'])}</code>" if failed.get("error") else "")
+        )
+    job = db["backups"].get(code)
+    if job is None:
+        return f"✅ копий {copies}" if backup_chats(f) else "❌ нет копий"
+    error = f"\nОшибка: <code>{html.escape(job['error'])}</code>" if job.get("error") else ""
+    due = datetime.fromtimestamp(job["due"], timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+    return (
+        f"⏳ в очереди, копий {copies}, попыток {job.get('attempts', 0)}, следующая <code>{due}</code>" + error
+    )
+
+def file_ids(f: dict) -> list[str]:
+    # file_id first, then the other replicas' (records from before replicas have only file_id)
+    return list(dict.fromkeys([f["file_id"], *(r["file_id"] for r in f.get("replicas", ()) if r.get("file_id"))]))
+
+def promote_file_id(code: str, file_id: str):
+    # a replica's file_id worked where the stored one didn't: serve it from now on
+    code = (db["files"].get(code) or {}).get("alias_of") or code
+    with db_tx():
+        f = db["files"].get(code)
+        if f is not None and f.get("file_id") != file_id:
+            f["file_id"] = file_id
+            db["files"][code] = f
+            invalidate_file(code)
+            save_db(db)
+
+def send_stored_file(chat_id, code: str, f: dict, caption: str, n: int = 0):
+    # queued without waiting; counts the download once Telegram accepted it
+    ids = file_ids(f)
+    fut = outbox.submit(chat_id, bot.send_document, (chat_id, ids[n]), {"caption": caption}, PRIO_INTERACTIVE)
 
-    file_id_to_store = backup_file_id or doc.file_id
+    def done(fut: Future):
+        e = fut.exception()
+        if e is None:
+            count_hit(code, f.get("u_id"), download=True)
+            if n:
+                promote_file_id(code, ids[n])
+        elif getattr(e, "error_code", None) == 400 and n + 1 < len(ids):
+            # 400: Telegram doesn't know this file_id (any more); try the next copy
+            metrics.inc("download_fallback_total")
+            send_stored_file(chat_id, code, f, caption, n + 1)
+        else:
+            print(f"Sending {code} failed: {e}")
+    fut.add_done_callback(done)
 
-    db["files"][code] = {
-        "file_id": file_id_to_store,
+# =======================
+# UPLOAD (backup copies go through the backup queue)
+# =======================
+async def upload_allowed(message: types.Message, user: dict) -> bool:
+    if is_admin(user["id"]):
+        return True
+    if has_active_sub(user):
+        # an album counts once: it is backed up with one forward_messages call
+        wait = limit_upload.hit(user["id"])
+        if wait:
+            await asend_message(message.chat.id, slow_down_text(wait))
+        return not wait
+    await asend_message(
+        message.chat.id,
+        "🔒 <b>Загрузка доступна по подписке.</b>\n"
+        f"Цена: <b>${get_price():.2f}</b> / месяц\n\n"
+        "Оплата подписки: <code>/pay</code>"
+    )
+    return False
+
+def new_file_record(doc, user: dict) -> dict:
+    # served with the sender's file_id until add_replicas() stores the backup's
+    return {
+        "file_id": doc.file_id,
+        "file_unique_id": doc.file_unique_id,
+        "file_name": doc.file_name or "",
+        "mime_type": doc.mime_type or "",
+        "u_id": user["id"],
+        "u_tag": user.get("tag", "—"),
+        "created_at": now_utc().strftime("%Y-%m-%d %H:%M UTC"),
+    }
+
+def dedup_upload(doc, user: dict):
+    # same file uploaded before: (code to give out, alias record or None);
+    # None when the file is new and has to be backed up
+    existing = find_by_unique(doc.file_unique_id) if DEDUP_POLICY != "off" else None
+    if not existing:
+        return None
+    if DEDUP_POLICY == "link":
+        return existing, None
+    return gen_code(), {
+        "alias_of": existing,
         "file_name": doc.file_name or "",
         "mime_type": doc.mime_type or "",
         "u_id": user["id"],
         "u_tag": user.get("tag", "—"),
         "created_at": now_utc().strftime("%Y-%m-%d %H:%M UTC"),
-        "backup_chat": CHANNEL_ID,
-        "backup_msg_id": getattr(forwarded, "message_id", None),
     }
-    save_db(db)
 
-    link = f"https://t.me/{bot.get_me().username}?start={code}"
-    bot.send_message(
+@bot.message_handler(content_types=["document"])
+@instrumented
+async def on_upload(message: types.Message):
+    if message.media_group_id:
+        buffer_album(message)
+        return
+
+    user = ensure_user(message.from_user)
+    if not await upload_allowed(message, user):
+        return
+
+    doc = message.document
+
+    # 0) same file uploaded before: no second backup copy
+    dup = dedup_upload(doc, user)
+    if dup:
+        code, alias = dup
+        if alias:
+            put_file(code, alias)
+        await asend_message(
+            message.chat.id,
+            "✅ <b>Файл сохранён.</b>\n\n"
+            f"🔗 Ссылка:\n<code>{file_link(code)}</code>\n\n"
+            "По ссылке файл можно скачать."
+        )
+        return
+
+    # the record and its backup job are written together; the link works at once
+    code = gen_code()
+    put_files([(code, new_file_record(doc, user))], [(code, backup_job(message, code))])
+
+    link = file_link(code)
+    await asend_message(
         message.chat.id,
         "✅ <b>Файл сохранён.</b>\n\n"
         f"🔗 Ссылка:\n<code>{link}</code>\n\n"
         "По ссылке файл можно скачать."
     )
 
-print("BOT STARTED")
-bot.infinity_polling(skip_pending=True)
+# Documents sent as one album (media_group_id) arrive as separate updates.
+# They are collected for ALBUM_WINDOW seconds after the last part and then
+# handled together: one forward_messages call, one DB write, one reply.
+_albums: dict = {}  # (chat_id, media_group_id) -> {"messages": [...], "timer": Timer or TimerHandle}
+_albums_lock = threading.Lock()
+
+def buffer_album(message: types.Message):
+    key = (message.chat.id, message.media_group_id)
+    with _albums_lock:
+        album = _albums.setdefault(key, {"messages": [], "timer": None})
+        album["messages"].append(message)
+        if album["timer"]:
+            album["timer"].cancel()
+        if ENGINE == "async":
+            album["timer"] = _aloop.call_later(ALBUM_WINDOW, flush_album, key)
+        else:
+            album["timer"] = threading.Timer(ALBUM_WINDOW, flush_album, args=(key,))
+            album["timer"].daemon = True
+            album["timer"].start()
+
+def flush_album(key):
+    with _albums_lock:
+        album = _albums.pop(key, None)
+    if not album:
+        return
+    messages = sorted(album["messages"], key=lambda m: m.message_id)
+    if ENGINE == "async":
+        _aloop.create_task(_process_album_logged(key, messages))
+    else:
+        run_sync(_process_album_logged(key, messages))
+
+async def _process_album_logged(key, messages: list):
+    try:
+        await process_album.run_async(messages)
+    except Exception as e:
+        print(f"Album {key} failed: {e}")
+
+@instrumented
+async def process_album(messages: list):
+    first = messages[0]
+    chat_id = first.chat.id
+    user = ensure_user(first.from_user)
+    if not await upload_allowed(first, user):
+        return
+
+    saved = []       # (code, file_name) in album order
+    records = []     # (code, record) to store
+    jobs = []        # (code, backup job) for new files
+    seen = {}        # file_unique_id -> code, for repeats inside the album
+    for m in messages:
+        doc = m.document
+        if doc.file_unique_id in seen:
+            saved.append((seen[doc.file_unique_id], doc.file_name))
+            continue
+        dup = dedup_upload(doc, user)
+        if dup:
+            code, alias = dup
+            if alias:
+                records.append((code, alias))
+        else:
+            code = gen_code()
+            records.append((code, new_file_record(doc, user)))
+            jobs.append((code, backup_job(m, batch=jobs[0][0] if jobs else code)))
+        seen[doc.file_unique_id] = code
+        saved.append((code, doc.file_name))
+
+    put_files(records, jobs)
+
+    lines = [f"✅ <b>Файлы сохранены: {len(saved)}</b>\n"]
+    for code, name in saved:
+        lines.append(f"• {html.escape(name or '—')}\n<code>{file_link(code)}</code>")
+    lines.append("\nПо ссылкам файлы можно скачать.")
+    await asend_message(chat_id, "\n".join(lines))
+
+# =======================
+# WEBHOOK (MODE=webhook)
+# =======================
+# One HTTP server takes Telegram updates and Crypto Pay webhooks, checks their
+# secrets and hands them to WEBHOOK_WORKERS threads. Updates are sharded by
+# chat id so one chat is always handled by the same worker, in order.
+# Local test: curl -X POST -H 'Content-Type: application/json' \
+#   --data @update.json http://127.0.0.1:8080/telegram
+_webhook_queues: list[queue.Queue] = []
+
+def update_chat_id(raw: dict):
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if isinstance(raw.get(key), dict):
+            return (raw[key].get("chat") or {}).get("id")
+    cq = raw.get("callback_query")
+    if isinstance(cq, dict):
+        msg = cq.get("message") or {}
+        return (msg.get("chat") or {}).get("id") or (cq.get("from") or {}).get("id")
+    for key in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query"):
+        if isinstance(raw.get(key), dict):
+            return (raw[key].get("from") or {}).get("id")
+    return None
+
+def verify_cryptopay_signature(body: bytes, signature: str) -> bool:
+    secret = hashlib.sha256(CRYPTOPAY_TOKEN.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected.encode(), (signature or "").encode())
+
+def handle_cryptopay_update(raw: dict):
+    if raw.get("update_type") != "invoice_paid":
+        return
+    rec, credited = apply_invoice_update(raw.get("payload") or {})
+    if credited:
+        notify_paid(int(rec["user_id"]))
+
+def submit_update(kind: str, raw: dict, shard_key=None, block: bool = False) -> bool:
+    if shard_key is None:
+        shard_key = update_chat_id(raw) if kind == "tg" else raw.get("update_id", 0)
+    if _aloop is not None:
+        return asyncio.run_coroutine_threadsafe(_aenqueue(kind, raw, shard_key), _aloop).result()
+    # in the supervisor (WORKERS > 1) Telegram updates go to worker processes
+    queues = _worker_queues if kind == "tg" and _worker_queues else _webhook_queues
+    q = queues[hash(shard_key or 0) % len(queues)]
+    try:
+        q.put((kind, raw), block=block)
+        return True
+    except queue.Full:
+        return False
+
+def _webhook_worker(q: queue.Queue):
+    while True:
+        kind, raw = q.get()
+        try:
+            if kind == "tg":
+                bot.process_new_updates([types.Update.de_json(raw)])
+            else:
+                handle_cryptopay_update(raw)
+        except Exception as e:
+            print(f"Webhook {kind} update failed: {e}")
+
+def start_webhook_workers(total: int = WEBHOOK_QUEUE):
+    per_worker = max(1, total // WEBHOOK_WORKERS)
+    for i in range(WEBHOOK_WORKERS):
+        q = queue.Queue(maxsize=per_worker)
+        _webhook_queues.append(q)
+        threading.Thread(target=_webhook_worker, args=(q,), name=f"webhook-{i}", daemon=True).start()
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    max_body = 1 << 20
+
+    def _reply(self, code: int, text: str = "ok"):
+        body = text.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            return self._reply(400, "bad length")
+        if length <= 0 or length > self.max_body:
+            return self._reply(413, "bad length")
+        body = self.rfile.read(length)
+        path = self.path.split("?", 1)[0]
+
+        if path == WEBHOOK_TG_PATH:
+            token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            # bytes: compare_digest rejects non-ASCII str
+            if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+                return self._reply(403, "forbidden")
+            kind = "tg"
+        elif path == WEBHOOK_CRYPTOPAY_PATH:
+            if not verify_cryptopay_signature(body, self.headers.get("crypto-pay-api-signature", "")):
+                return self._reply(403, "forbidden")
+            kind = "cryptopay"
+        else:
+            return self._reply(404, "not found")
+
+        try:
+            raw = json.loads(body)
+        except Exception:
+            return self._reply(400, "bad json")
+        if not isinstance(raw, dict):
+            return self._reply(400, "bad json")
+        if not submit_update(kind, raw):
+            return self._reply(503, "busy")  # Telegram / Crypto Pay will retry
+        self._reply(200)
+
+    def log_message(self, fmt, *args):
+        pass
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # listen() backlog; the default 5 resets bursts of connections
+
+def run_webhook():
+    if ENGINE == "sync":
+        start_webhook_workers()
+    if WEBHOOK_URL:
+        bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_TG_PATH,
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=True,
+        )
+    server = WebhookServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    print(f"WEBHOOK LISTENING on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+    server.serve_forever()
+
+# =======================
+# WORKERS (WORKERS > 1)
+# =======================
+# The supervisor process only receives updates (long polling or the webhook
+# server) and hands each raw update to one of WORKERS processes chosen by chat
+# id, so a chat — its order of updates, admin_state, album buffer — always
+# lives in one process. Workers share state through SQLite (see db_tx). The invoice reconciler, the sweeper, the snapshotter and
+# Crypto Pay webhooks stay in the supervisor; every process drains the backup
+# queue, which hands out jobs in a transaction. Worker n serves its own /metrics on METRICS_PORT + 1 + n.
+_worker_queues: list = []
+_worker_procs: list = []
+WORKER_INDEX = None  # set inside a worker process
+
+def _worker_main(n: int, q, username: str):
+    global METRICS_PORT, WORKER_INDEX, _bot_username
+    WORKER_INDEX = n
+    _bot_username = username
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    if METRICS_PORT:
+        METRICS_PORT += 1 + n
+    start_db_flusher()
+    start_stats_flusher()
+    start_metrics_server()
+    start_backup_queue()
+    # a short local queue: the backlog waits in the supervisor, which answers 503 when full
+    start_webhook_workers(WEBHOOK_WORKERS * 4)
+    while True:
+        kind, raw = q.get()
+        submit_update(kind, raw, block=True)
+
+def _spawn_worker(ctx, n: int):
+    p = ctx.Process(target=_worker_main, args=(n, _worker_queues[n], bot_username()), name=f"worker-{n}", daemon=True)
+    p.start()
+    _worker_procs[n] = p
+
+def _watch_workers(ctx):
+    while True:
+        time.sleep(5)
+        for n, p in enumerate(_worker_procs):
+            if not p.is_alive():
+                print(f"worker-{n} exited with {p.exitcode}, restarting")
+                _spawn_worker(ctx, n)
+
+def start_worker_processes():
+    # spawn, not fork: a child must not inherit the SQLite connection or threads
+    ctx = multiprocessing.get_context("spawn")
+    per_worker = max(1, WEBHOOK_QUEUE // WORKERS)
+    for n in range(WORKERS):
+        _worker_queues.append(ctx.Queue(maxsize=per_worker))
+        _worker_procs.append(None)
+        _spawn_worker(ctx, n)
+    threading.Thread(target=_watch_workers, args=(ctx,), name="worker-watch", daemon=True).start()
+
+def poll_to_workers():
+    # getUpdates loop of the supervisor; blocks when the worker's queue is full
+    last = apihelper.get_updates(TOKEN, offset=-1, timeout=10)  # skip pending, like infinity_polling
+    offset = last[-1]["update_id"] + 1 if last else None
+    while True:
+        try:
+            updates = apihelper.get_updates(TOKEN, offset=offset, timeout=35, long_polling_timeout=25)
+        except Exception as e:
+            print(f"getUpdates failed: {e}")
+            time.sleep(3)
+            continue
+        for raw in updates:
+            offset = raw["update_id"] + 1
+            submit_update("tg", raw, block=True)
+
+# =======================
+# ASYNC ENGINE (ENGINE=async)
+# =======================
+# One event loop takes updates from its own getUpdates loop or from the
+# webhook server threads and runs the same handlers as coroutines on an
+# AsyncTeleBot, so a handler waiting for Telegram or Crypto Pay costs a task,
+# not a thread. Updates of one chat still run one after another;
+# ASYNC_MAX_IN_FLIGHT bounds how many are handled at once. Database calls
+# stay synchronous: they are local and short.
+_aloop = None
+_a_slots = None            # asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+_a_chat_tails: dict = {}   # chat id -> future done when its latest update is handled
+_a_tasks: set = set()
+
+async def _aenqueue(kind: str, raw: dict, shard_key, wait: bool = False) -> bool:
+    if not wait and _a_slots.locked():
+        return False  # webhook answers 503, the sender retries
+    await _a_slots.acquire()
+    prev = done = None
+    if kind == "tg" and shard_key is not None:
+        prev = _a_chat_tails.get(shard_key)
+        done = _a_chat_tails[shard_key] = _aloop.create_future()
+    task = _aloop.create_task(_ahandle(kind, raw, shard_key, prev, done))
+    _a_tasks.add(task)
+    task.add_done_callback(_a_tasks.discard)
+    return True
+
+async def _ahandle(kind: str, raw: dict, shard_key, prev, done):
+    try:
+        if prev is not None:
+            await prev
+        if kind == "tg":
+            await abot.process_new_updates([types.Update.de_json(raw)])
+        else:
+            handle_cryptopay_update(raw)
+    except Exception as e:
+        print(f"Async {kind} update failed: {e}")
+    finally:
+        if done is not None:
+            done.set_result(None)
+            if _a_chat_tails.get(shard_key) is done:
+                del _a_chat_tails[shard_key]
+        _a_slots.release()
+
+async def _apoll():
+    url = (TELEGRAM_API_URL or "https://api.telegram.org") + f"/bot{TOKEN}/getUpdates"
+    payload = {"offset": -1, "timeout": 0}  # first call only skips pending updates
+    skipping = True
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=40)) as session:
+        while True:
+            try:
+                async with session.post(url, json=payload) as r:
+                    data = await r.json(content_type=None)
+                if not data.get("ok"):
+                    raise RuntimeError(str(data))
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError, ValueError) as e:
+                print(f"getUpdates failed: {e}")
+                await asyncio.sleep(3)
+                continue
+            updates = data["result"]
+            if updates:
+                payload["offset"] = updates[-1]["update_id"] + 1
+            elif skipping:
+                payload.pop("offset")
+            payload["timeout"] = 25
+            if skipping:
+                skipping = False
+                continue
+            for raw in updates:
+                await _aenqueue("tg", raw, update_chat_id(raw), wait=True)
+
+async def run_async():
+    global abot, _aloop, _a_slots
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+
+    if TELEGRAM_API_URL:
+        asyncio_helper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+        asyncio_helper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+    _aloop = asyncio.get_running_loop()
+    _a_slots = asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+    abot = AsyncTeleBot(TOKEN, parse_mode="HTML")
+    for h in bot.message_handlers:
+        abot.register_message_handler(h["function"].run_async, **h["filters"])
+    for h in bot.callback_query_handlers:
+        abot.register_callback_query_handler(h["function"].run_async, **h["filters"])
+    for h in bot.inline_handlers:
+        abot.register_inline_handler(h["function"].run_async, **h["filters"])
+    open_acrypto_session()
+
+    if MODE == "webhook":
+        await asyncio.to_thread(run_webhook)
+    else:
+        await asyncio.to_thread(bot.remove_webhook)
+        await _apoll()
+
+# =======================
+# RUN
+# =======================
+def _on_sigterm(signum, frame):
+    sys.exit(0)  # atexit -> flush_db(); daemon workers get SIGTERM too
+
+def main():
+    bot_username()  # cached: upload replies don't wait for getMe
+    start_db_flusher()
+    start_stats_flusher()
+    start_metrics_server()
+    start_invoice_reconciler()
+    start_sweeper()
+    start_snapshotter()
+    start_backup_queue()
+    signal.signal(signal.SIGTERM, _on_sigterm)
+
+    print("BOT STARTED")
+    if ENGINE == "async":
+        asyncio.run(run_async())
+        return
+    if WORKERS > 1:
+        start_worker_processes()
+        print(f"WORKERS: {WORKERS}")
+    if MODE == "webhook":
+        run_webhook()
+    elif WORKERS > 1:
+        bot.remove_webhook()
+        poll_to_workers()
+    else:
+        bot.remove_webhook()
+        bot.infinity_polling(skip_pending=True)
+
+if __name__ == "__main__":
+    main()